@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
 
+import sys
+
 from libtart.checker import PagerDutyJira
 
 checker = PagerDutyJira()
-checker.checkPagerDuty()
-checker.checkJira()
+concurrent = '--asyncio' in sys.argv[1:]
 
+if '--daemon' in sys.argv[1:]:
+    from libtart.daemon import Daemon
+    Daemon(checker, concurrent).run()
+elif concurrent:
+    import asyncio
+    asyncio.run(checker.checkConcurrently())
+else:
+    checker.checkPagerDuty()
+    checker.checkJira()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+##
+# Tart Integration
+#
+# Copyright (c) 2013, Tart İnternet Teknolojileri Ticaret AŞ
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose with or without fee is hereby
+# granted, provided that the above copyright notice and this permission notice appear in all copies.
+#
+# The software is provided "as is" and the author disclaims all warranties with regard to the software including all
+# implied warranties of merchantability and fitness. In no event shall the author be liable for any special, direct,
+# indirect, or consequential damages or any damages whatsoever resulting from loss of use, data or profits, whether
+# in an action of contract, negligence or other tortious action, arising out of or in connection with the use or
+# performance of this software.
+##
+
+import asyncio
+import inspect
+from weakref import WeakKeyDictionary
+from functools import partial
+
+from .api import JSONAPI
+from .jira import JiraClient
+from .pagerduty import PagerDutyClient
+
+class AsyncClient:
+    '''Asynchronous variant of a client with the same methods as coroutines, and the generators as asynchronous
+    generators. Blocking calls run on the executor of the event loop, so the loop can wait for many of them at
+    once. Calls are limited by a semaphore to the number of the connections of the client. The blocking client
+    is shared, so are its connections and caches.'''
+
+    def __init__(self, client, executor=None):
+        self.client = client
+        self.__executor = executor
+        self.__semaphores = WeakKeyDictionary()
+
+    def __semaphore(self):
+        '''Semaphores are created on the running loop, and forgotten with it.'''
+        loop = asyncio.get_running_loop()
+        if loop not in self.__semaphores:
+            self.__semaphores[loop] = asyncio.Semaphore(self.client.pool.size)
+        return self.__semaphores[loop]
+
+    async def run(self, function, *args, **kwargs):
+        '''Run a blocking function of the client or its resources like issues and incidents.'''
+        async with self.__semaphore():
+            return await asyncio.get_running_loop().run_in_executor(self.__executor, partial(function, *args,
+                                                                                             **kwargs))
+
+    async def __iterate(self, function, *args, **kwargs):
+        end = object()
+        iterator = await self.run(function, *args, **kwargs)
+        while True:
+            item = await self.run(next, iterator, end)
+            if item is end:
+                return
+            yield item
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+        if inspect.isgeneratorfunction(attribute):
+            return partial(self.__iterate, attribute)
+        return partial(self.run, attribute)
+
+class AsyncJSONAPI(AsyncClient):
+    clientClass = JSONAPI
+
+    def __init__(self, *args, **kwargs):
+        AsyncClient.__init__(self, self.clientClass(*args, **kwargs))
+
+class AsyncJiraClient(AsyncJSONAPI):
+    clientClass = JiraClient
+
+class AsyncPagerDutyClient(AsyncJSONAPI):
+    clientClass = PagerDutyClient
@@ -14,17 +14,227 @@
 # performance of this software.
 ##
 
+import re
+import zlib
+import gzip
 import json
 import time
+import random
+import select
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .metrics import metrics
+
+def prefetched(iterable):
+    '''Iterate the items while fetching the next one on a background thread. Useful to get the next page of
+    a paginated resource while the current one is processed.'''
+    from concurrent.futures import ThreadPoolExecutor
+
+    iterator = iter(iterable)
+    end = object()
+    executor = ThreadPoolExecutor(1)
+    try:
+        future = executor.submit(next, iterator, end)
+        while True:
+            item = future.result()
+            if item is end:
+                return
+            future = executor.submit(next, iterator, end)
+            yield item
+    finally:
+        executor.shutdown(wait=False)
+
+class ConnectionPool:
+    '''Keep persistent HTTP connections per host to reuse them on the following requests. Connections are taken
+    out of the pool while they are in use, so a pool can be shared by threads.'''
+
+    def __init__(self, size=4):
+        self.size = int(size)
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    def get(self, scheme, host, timeout):
+        '''Return an idle connection to the host if there is one, a new one otherwise. Second value of the tuple
+        is true for the reused connections. Socket operations of the connection time out after the seconds. Idle
+        connections readable are closed by the server, they are dropped.'''
+        while True:
+            with self.__lock:
+                connections = self.__idle.get((scheme, host))
+                connection = connections.pop() if connections else None
+            if not connection:
+                break
+            if not connection.sock or select.select([connection.sock], [], [], 0)[0]:
+                connection.close()
+                continue
+            connection.timeout = timeout
+            connection.sock.settimeout(timeout)
+            return connection, True
+
+        from http.client import HTTPConnection, HTTPSConnection
+        if scheme == 'https':
+            return HTTPSConnection(host, timeout=timeout), False
+        return HTTPConnection(host, timeout=timeout), False
+
+    def put(self, scheme, host, connection):
+        with self.__lock:
+            connections = self.__idle.setdefault((scheme, host), [])
+            if len(connections) < self.size:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.__lock:
+            for connections in self.__idle.values():
+                for connection in connections:
+                    connection.close()
+            self.__idle.clear()
+
+class RequestScheduler:
+    '''Throttle the requests to a host with a token bucket which allows the rate per second with bursts up to the
+    burst size. Tokens are reserved in order, so waiting threads are served fairly. Requests can be paused for all
+    the users of the host, for example after a Retry-After header. Requests at the same time can be limited to
+    the concurrency. Schedulers are shared by the clients of the same host.'''
+
+    __schedulers = {}
+    __schedulersLock = threading.Lock()
+
+    @classmethod
+    def forHost(cls, host, rate, burst, concurrency=0):
+        with cls.__schedulersLock:
+            if host not in cls.__schedulers:
+                cls.__schedulers[host] = cls(rate, burst, concurrency)
+            return cls.__schedulers[host]
+
+    def __init__(self, rate, burst, concurrency=0):
+        self.__rate = float(rate)
+        self.__burst = float(burst)
+        self.__tokens = self.__burst
+        self.__updatedAt = time.time()
+        self.__pausedUntil = 0
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(int(concurrency)) if int(concurrency) else None
+
+    def wait(self):
+        '''Wait for the turn of the request, return the seconds waited.'''
+        with self.__lock:
+            now = time.time()
+            seconds = max(0, self.__pausedUntil - now)
+            if self.__rate:
+                self.__tokens = min(self.__burst, self.__tokens + (now - self.__updatedAt) * self.__rate)
+                self.__updatedAt = now
+                self.__tokens -= 1
+                seconds = max(seconds, -self.__tokens / self.__rate)
+        if seconds:
+            time.sleep(seconds)
+        return seconds
+
+    def pause(self, seconds):
+        with self.__lock:
+            self.__pausedUntil = max(self.__pausedUntil, time.time() + seconds)
+
+    def acquire(self):
+        '''Wait for one of the concurrent requests to complete if there are too many, return the seconds waited.
+        It should be released when the request completes.'''
+        if not self.__slots:
+            return 0
+        startedAt = time.time()
+        self.__slots.acquire()
+        return time.time() - startedAt
+
+    def release(self):
+        if self.__slots:
+            self.__slots.release()
+
+class ValidatorCache:
+    '''Keep the responses with the ETag or the Last-Modified headers to make the following requests to the same
+    addresses conditional. Least recently used ones are dropped when the cache is full.'''
+
+    def __init__(self, size=100):
+        self.__size = size
+        self.__responses = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def conditional(self, request):
+        '''Add the validators of the cached response to the request, return the response or None.'''
+        with self.__lock:
+            response = self.__responses.get(request.full_url)
+            if not response:
+                return None
+            self.__responses.move_to_end(request.full_url)
+        if response.headers().get('ETag'):
+            request.add_header('If-None-Match', response.headers().get('ETag'))
+        if response.headers().get('Last-Modified'):
+            request.add_header('If-Modified-Since', response.headers().get('Last-Modified'))
+        return response
+
+    def store(self, request, response):
+        if not response.headers().get('ETag') and not response.headers().get('Last-Modified'):
+            return
+        with self.__lock:
+            self.__responses[request.full_url] = response
+            self.__responses.move_to_end(request.full_url)
+            while len(self.__responses) > self.__size:
+                self.__responses.popitem(last=False)
 
 class JSONAPI:
-    def __init__(self, address, username=None, password=None, token=None, syslog=False, application=None):
+    '''Idempotent requests are retried on connection errors and on server errors, all requests are retried on
+    429 Too Many Requests. Retries wait as long as the Retry-After header says, or with jittered exponential
+    backoff. Compressed responses are accepted. Responses of the GET requests to the validated resources are cached
+    with their validators to send them conditionally, the cached ones are used when not modified. Requests time
+    out after the seconds, or the remaining seconds of the budgets of the running checks, and they are not retried
+    after them.'''
+
+    retryBaseSeconds = 1
+    retryMaxSeconds = 60
+    minimumTimeoutSeconds = 1
+    idempotentMethods = ('GET', 'PUT')
+
+    '''Regular expressions to match the whole resources which rarely change. Responses of the others, like the
+    pages of the searches, would fill the cache without being used again.'''
+    validatedResources = ()
+
+    def __init__(self, address, username=None, password=None, token=None, syslog=False, application=None,
+                 connections=4, rate=0, burst=10, retries=3, validators=100, concurrency=0, timeout=60):
+        from urllib.parse import urlsplit
+
         self.address = address
         self.username = username
         self.password = password
         self.token = token
-        self.syslog = syslog
+        self.syslog = syslog not in (False, 'no', 'false', 'off', '0')
         self.application = application
+        if self.syslog and self.application:
+            import syslog
+            syslog.openlog(self.application)
+        self.pool = ConnectionPool(connections)
+        self.scheduler = RequestScheduler.forHost(urlsplit(address).netloc, rate, burst, concurrency)
+        self.retries = int(retries)
+        self.validators = ValidatorCache(int(validators))
+        self.timeout = float(timeout)
+        self.__budgets = []
+        self.__budgetsLock = threading.Lock()
+
+    @contextmanager
+    def budget(self, budget):
+        '''Cap the requests at the remaining seconds of the budget in the context. Checks running at the same
+        time share the client, so the requests are capped at the longest of their remaining seconds.'''
+        with self.__budgetsLock:
+            self.__budgets.append(budget)
+        try:
+            yield
+        finally:
+            with self.__budgetsLock:
+                self.__budgets.remove(budget)
+
+    def __remaining(self):
+        with self.__budgetsLock:
+            return max((budget.remaining() for budget in self.__budgets), default=float('inf'))
+
+    def __timeout(self):
+        return max(self.minimumTimeoutSeconds, min(self.timeout, self.__remaining()))
 
     def __encodeParameters(self, parameters):
         from urllib.parse import quote_plus
@@ -42,7 +252,7 @@ class JSONAPI:
             address += '?' + '&'.join(key + '=' + value for key, value in self.__encodeParameters(getParameters))
         request = Request(address)
         if postParameters is not None:
-            request.add_data(json.dumps(postParameters).encode('utf-8'))
+            request.data = json.dumps(postParameters).encode('utf-8')
 
         if self.username:
             from base64 import urlsafe_b64encode
@@ -52,34 +262,171 @@ class JSONAPI:
         elif self.token:
             request.add_header('Authorization', 'Token token=' + self.token)
         request.add_header('Content-type', 'application/json')
+        request.add_header('Accept-Encoding', 'gzip, deflate')
         return request
 
+    def __decode(self, encoding, content):
+        if encoding == 'gzip':
+            return gzip.decompress(content)
+        if encoding == 'deflate':
+            '''Some servers send raw deflate without the zlib header.'''
+            try:
+                return zlib.decompress(content)
+            except zlib.error:
+                return zlib.decompress(content, -zlib.MAX_WBITS)
+        return content
+
+    def __send(self, request):
+        '''Send the request over a pooled connection. Servers drop the idle connections after a while, so
+        the request is sent again on a new connection if a reused one fails while sending it. The ones failed
+        while waiting for the response may have been processed by the server, only the idempotent ones are sent
+        again.'''
+        from urllib.parse import urlsplit
+        from http.client import BadStatusLine, ImproperConnectionState
+
+        address = urlsplit(request.full_url)
+        path = address.path + ('?' + address.query if address.query else '')
+        while True:
+            connection, reused = self.pool.get(address.scheme, address.netloc, self.__timeout())
+            sent = False
+            try:
+                connection.request(request.get_method(), path, request.data, dict(request.header_items()))
+                sent = True
+                response = connection.getresponse()
+                content = response.read()
+            except (ConnectionError, BadStatusLine, ImproperConnectionState):
+                connection.close()
+                if reused and (not sent or self.__idempotent(request)):
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.put(address.scheme, address.netloc, connection)
+
+            return JSONResponse(request.full_url, response.status, response.reason, response.msg,
+                                self.__decode(response.getheader('Content-Encoding'), content), len(content))
+
+    def __idempotent(self, request):
+        '''Requests can be marked not idempotent even if their methods are, like the edits adding comments.'''
+        return getattr(request, 'idempotent', request.get_method() in self.idempotentMethods)
+
+    def __retryAfter(self, response):
+        '''Return the seconds on the Retry-After header which can be a date too.'''
+        value = response.headers().get('Retry-After')
+        if value:
+            try:
+                return max(0, float(value))
+            except ValueError:
+                from email.utils import parsedate_to_datetime
+                try:
+                    return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+                except (TypeError, ValueError): pass
+
+    def __backoff(self, attempt):
+        return random.uniform(0.5, 1) * min(self.retryMaxSeconds, self.retryBaseSeconds * 2 ** attempt)
+
     def __makeRequest(self, request):
-        from urllib.request import urlopen
-        from urllib.error import HTTPError
+        '''Send the request with retries. Seconds waited for throttling and retries are logged separately from the
+        seconds waited for the responses.'''
+        from http.client import HTTPException
 
         response = None
-        startedAt = time.time()
+        attempt = 0
+        seconds = 0
+        throttledSeconds = 0
         try:
-            response = urlopen(request)
-        except HTTPError as error:
-            response = error
+            while True:
+                throttledSeconds += self.scheduler.wait()
+                throttledSeconds += self.scheduler.acquire()
+                startedAt = time.time()
+                try:
+                    response = self.__send(request)
+                except (OSError, HTTPException):
+                    if not self.__idempotent(request) or attempt >= self.retries:
+                        raise
+                    delay = self.__backoff(attempt)
+                    if delay >= self.__remaining():
+                        raise
+                else:
+                    if attempt >= self.retries:
+                        break
+                    if response.code() == 429:
+                        delay = self.__retryAfter(response)
+                        if delay is None:
+                            delay = self.__backoff(attempt)
+                        self.scheduler.pause(delay)
+                    elif response.serverError() and self.__idempotent(request):
+                        delay = self.__retryAfter(response)
+                        if delay is None:
+                            delay = self.__backoff(attempt)
+                    else:
+                        break
+                    if delay >= self.__remaining():
+                        break
+                finally:
+                    self.scheduler.release()
+                    seconds += time.time() - startedAt
+
+                time.sleep(delay)
+                throttledSeconds += delay
+                attempt += 1
         finally:
+            self.__measure(request, response, seconds, attempt, throttledSeconds)
             if self.syslog:
                 message = request.get_method() + ' ' + request.get_full_url()
                 if response:
-                    message += ' response: ' + str(response.getcode())
-                message += ' seconds: ' + str(time.time() - startedAt)
+                    message += ' response: ' + str(response.code())
+                message += ' seconds: ' + str(seconds)
+                if attempt:
+                    message += ' retries: ' + str(attempt)
+                if throttledSeconds:
+                    message += ' throttled seconds: ' + str(throttledSeconds)
                 import syslog
-                if self.application:
-                    syslog.openlog(self.application)
                 syslog.syslog(message)
 
-        return JSONResponse(response)
+        return response
+
+    def __measure(self, request, response, seconds, retries, throttledSeconds):
+        '''Record the request to the metrics. Path segments with digits are identifiers, they are replaced to
+        group the requests by the endpoint.'''
+        from urllib.parse import urlsplit
+
+        address = urlsplit(request.full_url)
+        path = request.full_url[len(self.address):].split('?', 1)[0]
+        endpoint = '/'.join('{id}' if any(character.isdigit() for character in part) else part
+                            for part in path.split('/'))
+        labels = {'host': address.netloc, 'method': request.get_method(), 'endpoint': endpoint}
+
+        metrics.increment('tart_api_requests_total', 'Requests by the response code, 0 for the failed ones.',
+                          code=response.code() if response else 0, **labels)
+        metrics.observe('tart_api_request_seconds', 'Seconds waited for the responses including the retries.',
+                        seconds, **labels)
+        metrics.increment('tart_api_sent_bytes_total', 'Bytes of the request bodies.', len(request.data or b''),
+                          **labels)
+        if response:
+            metrics.increment('tart_api_received_bytes_total', 'Bytes of the response bodies.', response.size(),
+                              **labels)
+        if retries:
+            metrics.increment('tart_api_retries_total', 'Retried requests.', retries, **labels)
+        if throttledSeconds:
+            metrics.increment('tart_api_throttled_seconds_total', 'Seconds waited for the rate limits and the '
+                              'retries.', throttledSeconds, host=address.netloc)
 
     def get(self, uri, parameters=None):
-        response = self.__makeRequest(self.__request(uri, parameters))
+        request = self.__request(uri, parameters)
+        validated = any(re.fullmatch(resource, uri) for resource in self.validatedResources)
+        cachedResponse = self.validators.conditional(request) if validated else None
+        response = self.__makeRequest(request)
+        if response.code() == 304 and cachedResponse:
+            return cachedResponse.copy().body()
         if response.successful():
+            if validated:
+                self.validators.store(request, response)
             return response.body()
         response.raiseAsError()
 
@@ -89,9 +436,11 @@ class JSONAPI:
             return response.body()
         response.raiseAsError()
 
-    def put(self, uri, parameters={}):
+    def put(self, uri, parameters={}, idempotent=True):
+        '''Put the parameters, return false on the client errors. Requests not idempotent are not retried.'''
         request = self.__request(uri, postParameters=parameters)
         request.get_method = lambda: 'PUT'
+        request.idempotent = idempotent
         response = self.__makeRequest(request)
         if response.successful():
             return response.body()
@@ -102,28 +451,52 @@ class JSONAPI:
 class JSONResponse:
     debug = True
 
-    def __init__(self, message):
-        self.__message = message
+    def __init__(self, address, code, reason, headers, content, size=None):
+        self.__address = address
+        self.__code = code
+        self.__reason = reason
+        self.__headers = headers
+        self.__content = content
+        self.__size = len(content) if size is None else size
+        self.__body = None
+        self.__decoded = False
+
+    def copy(self):
+        '''Return the response to be decoded again, not to share the body.'''
+        return JSONResponse(self.__address, self.__code, self.__reason, self.__headers, self.__content, self.__size)
 
     def body(self):
-        with self.__message:
+        '''Decode the content once.'''
+        if not self.__decoded:
             try:
-                return json.loads(self.__message.read().decode('utf-8'))
+                self.__body = json.loads(self.__content.decode('utf-8'))
             except ValueError: pass
+            self.__decoded = True
+        return self.__body
+
+    def headers(self):
+        return self.__headers
 
     def raiseAsError(self):
+        from io import BytesIO
+        from urllib.error import HTTPError
+
         if self.debug:
             print('\n=== Response ===\n')
-            print(str(self.__message.info()))
+            print(str(self.__headers))
             print(str(self.body()))
             print(('\n' * 2) + ('=' * 50) + '\n')
-        raise self.__message
+        raise HTTPError(self.__address, self.__code, self.__reason, self.__headers, BytesIO(self.__content))
 
     def code(self):
-        return self.__message.getcode()
+        return self.__code
+
+    def size(self):
+        '''Return the size of the content as received.'''
+        return self.__size
 
     def __str__(self):
-        return str(self.__message)
+        return str(self.__code) + ' ' + str(self.__reason)
 
     def information(self):
         return 100 <= self.code() < 200
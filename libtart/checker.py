@@ -14,54 +14,588 @@
 # performance of this software.
 ##
 
+import os
 import re
-
-from .jira import JiraClient, Issue
+import json
+import zlib
+import time
+import asyncio
+import calendar
+import threading
+import traceback
+from weakref import WeakValueDictionary
+from contextlib import contextmanager, ExitStack
+from collections import OrderedDict
+from functools import partial
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+
+from .jira import JiraClient, Issue, UserCache
 from .pagerduty import PagerDutyClient
-from .configuration import ConfigParser
-from .database import TimestampDatabase
+from .configuration import ConfigParser, Rules
+from .database import StateDatabase, LinkDatabase, Leased
+from .pipeline import KeyedPipeline, Budget, coalesced
+from .metrics import metrics
+from .aio import AsyncClient
 
 class PagerDutyJira:
     def __init__(self):
         config = ConfigParser('api.conf')
         self.__jira = JiraClient(**dict(config.items('Jira')))
+        self.__jira.userCache = UserCache(self.jiraUserCacheFile)
         self.__pagerDuty = PagerDutyClient(**dict(config.items('PagerDuty')))
         self.__actionConfig = ConfigParser('action.conf')
         self.__serviceConfig = ConfigParser('service.conf')
+        self.__integrationConfig = ConfigParser('integration.conf')
+        self.__rules = Rules(self.__actionConfig, self.__serviceConfig)
+        self.__shards = self.__integrationConfig.getint('Sharding', 'shards', fallback=1)
+        if self.__shards > 1 and self.__integrationConfig.has_option('Sharding', 'directory'):
+            '''Write-ahead log of the SQLite does not work on the network file systems.'''
+            directory = self.__integrationConfig.get('Sharding', 'directory')
+            self.__links = LinkDatabase(os.path.join(directory, os.path.basename(self.linkDatabaseFile)), 'delete')
+        else:
+            self.__links = LinkDatabase(self.linkDatabaseFile)
+        self.__stormIssues = {}
+        self.__incidentLocks = WeakValueDictionary()
+        self.__incidentLocksLock = threading.Lock()
+        self.__loop = None
+        self.stopped = None
+
+    def reload(self):
+        '''Read the action and the service configurations again if they have changed, and build the rules of them
+        only then.'''
+        actionChanged = self.__actionConfig.changed()
+        if actionChanged:
+            self.__actionConfig = ConfigParser(self.__actionConfig.filename)
+        serviceChanged = self.__serviceConfig.changed()
+        if serviceChanged:
+            self.__serviceConfig = ConfigParser(self.__serviceConfig.filename)
+        if actionChanged or serviceChanged:
+            self.__rules = Rules(self.__actionConfig, self.__serviceConfig)
+
+    jiraUserCacheFile = '/tmp/tart-integration.jira.users'
+    linkDatabaseFile = '/tmp/tart-integration.links.db'
+
+    def __bootstrapLinks(self):
+        '''Fill the link database with the remote links and the summaries of the open issues once.'''
+        linksBootstrapped = self.__links.bootstrapped()
+        summariesBootstrapped = self.__links.bootstrapped('summariesBootstrapped')
+        if linksBootstrapped and summariesBootstrapped:
+            return
 
+        for issue in self.__jira.openIssues(self.__rules.projectIssuetypes):
+            if not summariesBootstrapped:
+                self.__indexIssue(issue)
+            if not linksBootstrapped:
+                for remotelink in issue.getRemotelinks():
+                    self.__links.link(remotelink['globalId'], str(issue),
+                                      remotelink['object']['status']['resolved'])
+        self.__links.setBootstrapped()
+        self.__links.setBootstrapped('summariesBootstrapped')
+
+    def __indexIssue(self, issue):
+        fields = issue['fields']
+        self.__links.index(str(issue), fields['project']['key'], fields['issuetype']['name'], fields['summary'],
+                           fields['updated'])
+
+    stateDatabaseFile = '/tmp/tart-integration.state.db'
     checkPagerDutyTimestampFile = '/tmp/tart-integration.pagerduty.ts'
 
+    checkPagerDutyWorkers = 1
+    checkPagerDutyCoalesceSeconds = 0
+    checkPagerDutyBudgetSeconds = 300
+
+    shardLeaseSeconds = 300
+
+    def __stateDatabase(self, name, timestampFilename, initialName=None, lockName=None):
+        '''Lease the checks on the state database shared by the workers when sharded, instead of blocking.'''
+        if self.__shards == 1:
+            return StateDatabase(self.stateDatabaseFile, name, timestampFilename, lockName=lockName)
+
+        leaseSeconds = self.__integrationConfig.getfloat('Sharding', 'lease-seconds', fallback=self.shardLeaseSeconds)
+        if self.__integrationConfig.has_option('Sharding', 'directory'):
+            filename = os.path.join(self.__integrationConfig.get('Sharding', 'directory'),
+                                    os.path.basename(self.stateDatabaseFile))
+            return StateDatabase(filename, name, timestampFilename, leaseSeconds, initialName, 'delete', lockName)
+        return StateDatabase(self.stateDatabaseFile, name, timestampFilename, leaseSeconds, initialName,
+                             lockName=lockName)
+
+    def __shardName(self, shard):
+        if shard is None:
+            return 'pagerduty'
+        return 'pagerduty.' + str(shard)
+
+    def __journalDatabase(self, shard):
+        '''Drain the journal of the shard under its own lock, so the log entries are journaled during the drain.'''
+        return self.__stateDatabase(self.__shardName(shard), None, lockName=self.__shardName(shard) + '.journal')
+
+    def __shard(self, logEntry):
+        for shard in range(self.__shards):
+            if logEntry['service']['name'] in self.__rules.shardServices(shard, self.__shards):
+                return shard
+
     def checkPagerDuty(self):
-        with TimestampDatabase(self.checkPagerDutyTimestampFile) as database:
-            for logEntry in self.__pagerDuty.logEntries(database.read()):
-                if 'notification' in logEntry and logEntry['notification']['status'] == 'in_progress':
-                    '''Stop progress for now to buy time.'''
+        '''Process the new log entries within the budget of the run, return the number of them.'''
+        budget = self.__budget(self.__integrationConfig.getfloat('PagerDuty', 'budget-seconds',
+                                                                 fallback=self.checkPagerDutyBudgetSeconds))
+        self.__pagerDuty.clearIncidents()
+        try:
+            with self.__budgeted(budget):
+                if self.__shards > 1:
+                    return self.__checkPagerDutyShards(budget)
+                return self.__checkPagerDuty(budget)
+        finally:
+            self.__jira.userCache.save()
+            self.exportMetrics()
+
+    def __budget(self, seconds):
+        '''Stop the checks at the next item when the stopped event is set.'''
+        return Budget(seconds, stopped=self.stopped)
+
+    @contextmanager
+    def __budgeted(self, budget):
+        '''Cap the requests to the APIs at the remaining seconds of the budget.'''
+        with self.__jira.budget(budget), self.__pagerDuty.budget(budget):
+            yield
+
+    def __checkPagerDutyShards(self, budget):
+        '''Check the shards which are not leased by the other workers, starting from a different one on every
+        worker. Shards of the dead workers are taken over when their leases expire.'''
+        first = zlib.crc32(StateDatabase.owner().encode('utf-8')) % self.__shards
+        return self.__checkPagerDuty(budget, [(first + number) % self.__shards for number in range(self.__shards)])
+
+    def __checkPagerDuty(self, budget, shards=(None,)):
+        '''Journal the new log entries of the shards, fetched once for all of them, then drain the journals of
+        the shards. Cursors of the shards start from the one of the unsharded check. The cursors are committed
+        before the journals are drained.'''
+        databases = OrderedDict()
+        with ExitStack() as stack:
+            for shard in shards:
+                try:
+                    databases[shard] = stack.enter_context(self.__stateDatabase(
+                            self.__shardName(shard), self.checkPagerDutyTimestampFile, 'pagerduty'))
+                except Leased:
+                    metrics.increment('tart_shards_leased_total', 'Shards skipped as leased by the other workers.')
+            if not databases:
+                return 0
+            self.__bootstrapLinks()
+            self.__journalLogEntries(databases)
+
+        count = 0
+        for shard in databases:
+            try:
+                with self.__journalDatabase(shard) as database:
+                    count += self.__drainJournal(database, budget)
+            except Leased:
+                metrics.increment('tart_shards_leased_total', 'Shards skipped as leased by the other workers.')
+        return count
+
+    def __processed(self, database, logEntry):
+        '''Log entries are matched by the events only to the ones of the other source.'''
+        return database.processed(logEntry['id']) or database.processed(logEntry.event(not logEntry.webhook()))
+
+    def __addProcessed(self, database, logEntries):
+        for logEntry in logEntries:
+            database.add(logEntry['id'])
+            database.add(logEntry.event())
+
+            metrics.increment('tart_log_entries_processed_total', 'Log entries processed by the type.',
+                              type=logEntry['type'])
+            metrics.observe('tart_log_entry_lag_seconds', 'Seconds from the creation of the log entries to the end '
+                            'of their processing.', time.time() - self.__timestamp(logEntry['created_at']))
+
+    def __timestamp(self, value):
+        '''Parse the UTC time in ISO format of the PagerDuty.'''
+        return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+    def exportMetrics(self):
+        textfile = self.__integrationConfig.get('Metrics', 'textfile', fallback=None)
+        if textfile:
+            metrics.writeTextfile(textfile)
+
+    def __journalLogEntries(self, databases):
+        '''Append the new log entries to the journals of their shards and move the cursors after them, without
+        waiting for the Jira. Log entries are fetched once from the earliest cursor, the ones of the other shards
+        and the ones before the cursors of their shards are left out. Park the incidents with the notifications in
+        progress to buy time: leave their log entries to the following runs, and keep the cursor of the shard before
+        the first one of them. Log entries of the other incidents are journaled, they are skipped when they come
+        again. Notifications in progress longer than the parking seconds are processed as they are, not to hold
+        the cursor back until the processed log entries after it are forgotten. Return the number of the journaled
+        ones.
+
+        Changes of a shard are committed before changing another one, as one connection at a time can write.'''
+        count = 0
+        cursors = dict((shard, database.read()) for shard, database in databases.items())
+        parked = dict((shard, set()) for shard in databases)
+        parkingSeconds = self.__integrationConfig.getfloat('PagerDuty', 'parking-seconds',
+                                                           fallback=self.checkPagerDutyParkingSeconds)
+        changed = None
+        try:
+            for logEntry in self.__pagerDuty.logEntries(min(cursors.values())):
+                shard = self.__shard(logEntry) if self.__shards > 1 else None
+                database = databases.get(shard)
+                if not database or logEntry['created_at'] < cursors[shard]:
+                    continue
+                if changed is not None and changed is not database:
+                    changed.commit()
+                changed = database
+                if self.__processed(database, logEntry) or database.journaled(logEntry['id']):
+                    continue
+                incidentId = logEntry['incident']['id']
+                if incidentId in parked[shard] or ('notification' in logEntry and
+                                                   logEntry['notification']['status'] == 'in_progress' and
+                                                   self.__timestamp(logEntry['created_at']) >
+                                                   time.time() - parkingSeconds):
+                    parked[shard].add(incidentId)
+                    metrics.increment('tart_log_entries_parked_total', 'Log entries left to the following runs as '
+                                      'the notifications of their incidents are in progress.')
+                    continue
+                self.__journal(database, logEntry)
+                if not parked[shard]:
+                    database.write(logEntry['created_at'], logEntry['id'])
+                count += 1
+        finally:
+            if changed is not None:
+                changed.commit()
+        return count
+
+    def __journal(self, database, logEntry):
+        database.journal(logEntry['id'], logEntry['incident']['id'], json.dumps(logEntry))
+        metrics.increment('tart_log_entries_journaled_total', 'Log entries appended to the journal.')
+
+    checkPagerDutyStormTriggers = 30
+
+    '''Seconds to park the incidents, well below the seconds the processed log entries are kept.'''
+    checkPagerDutyParkingSeconds = 3600
+
+    def __createStormIssues(self, logEntries, workers):
+        '''Create the issues of the incidents in bulk when the incidents triggered on the journal are more than the
+        storm triggers in a minute. Incidents are looked up by the workers first, the ones without issues are
+        created with a single request for every maximum bulk issues. Issues are kept with their statuses to be found
+        when the log entries are processed, which transition and link the issues in parallel.'''
+        stormTriggers = self.__integrationConfig.getfloat('PagerDuty', 'storm-triggers',
+                                                          fallback=self.checkPagerDutyStormTriggers)
+        creating = OrderedDict()
+        for logEntry in logEntries:
+            action = self.__rules.actions.get(logEntry['type'])
+            service = self.__rules.services.get(logEntry['service']['name'])
+            if action and action.create and service and logEntry['incident']['id'] not in creating:
+                creating[logEntry['incident']['id']] = service, logEntry
+        if not stormTriggers or len(creating) < 2:
+            return
+        timestamps = [self.__timestamp(logEntry['created_at']) for service, logEntry in creating.values()]
+        if len(creating) / max(max(timestamps) - min(timestamps), 60) * 60 <= stormTriggers:
+            return
+
+        def creation(item):
+            service, logEntry = item
+            incident = logEntry.incident()
+            if incident['status'] != 'resolved' and not self.__findIssue(service.project, service.issuetype,
+                                                                         incident):
+                return incident, service, self.__issueFields(service, incident, logEntry)
+
+        try:
+            with ThreadPoolExecutor(workers) as executor:
+                creations = self.__distinctCreations(creation for creation in executor.map(creation, creating.values())
+                                                     if creation)
+            issues = self.__jira.createIssues([fields for incident, service, fields in creations])
+        except Exception:
+            '''The log entries will create their issues one by one.'''
+            traceback.print_exc()
+            return
+        for (incident, service, fields), issue in zip(creations, issues):
+            if issue:
+                self.__created(issue, incident, service, fields)
+                self.__stormIssues[str(incident)] = issue
+        metrics.increment('tart_storms_total', 'Storms of the incidents which their issues are created in bulk.')
+
+    def __distinctCreations(self, creations):
+        '''Leave the incidents out which would match the issues created before them, as they would when the issues
+        are created one by one.'''
+        distinct = []
+        for incident, service, fields in creations:
+            words = LinkDatabase.words(self.__matchingSummary(incident))
+            if not any((service.project, service.issuetype) == (other.project, other.issuetype) and
+                       words <= LinkDatabase.words(otherFields['summary'])
+                       for otherIncident, other, otherFields in distinct):
+                distinct.append((incident, service, fields))
+        return distinct
+
+    journalRetrySeconds = 60
+    journalMaxRetrySeconds = 3600
+    journalMaxAttempts = 10
+
+    def __drainJournal(self, database, budget):
+        '''Process the log entries on the journal of different incidents in parallel by the workers, the ones of
+        the same incident in order. Process the log entries of the same incident within the coalesce seconds
+        together with their net effect. Remove them from the journal when processed. Return the number of them.
+
+        Retry the failed log entries later with exponentially longer delays, the log entries after them of the same
+        incidents wait for them to keep the order. Drop the log entries failed with the permanent client errors, or
+        failed the maximum attempts, not to hold the incidents back. Stop
+        before the log entries which are not estimated to complete in the remaining seconds of the budget. Defer the
+        log entries which only comment when the remaining seconds are reserved for the others, and the log entries
+        after them of the same incidents.'''
+        workers = self.__integrationConfig.getint('PagerDuty', 'workers', fallback=self.checkPagerDutyWorkers)
+        seconds = self.__integrationConfig.getfloat('PagerDuty', 'coalesce-seconds',
+                                                    fallback=self.checkPagerDutyCoalesceSeconds)
+        pipeline = KeyedPipeline(workers)
+        failed = set()
+        count = 0
+
+        def journaledLogEntries():
+            waiting = set()
+            for entry, key, content, attempts, retryAt in database.journalEntries():
+                if key in waiting or retryAt > time.time():
+                    waiting.add(key)
+                    continue
+                yield self.__pagerDuty.logEntry(json.loads(content)), attempts
+
+        def committed(function, *arguments):
+            '''Commit after every group not to keep the journal locked for the intake while waiting for the APIs.'''
+            try:
+                function(*arguments)
+            finally:
+                database.commit()
+
+        def processGroup(group, types):
+            nonlocal count
+            incidentId = group[0][0]['incident']['id']
+            if incidentId in failed:
+                return
+            logEntries = []
+            for logEntry, attempts in group:
+                if self.__processed(database, logEntry):
+                    '''The same event is received from the other source while it was on the journal.'''
+                    database.unjournal(logEntry['id'])
+                else:
+                    logEntries.append(logEntry)
+            if not logEntries:
+                return
+            startedAt = time.time()
+            try:
+                self.__processLogEntries(logEntries)
+            except Exception as error:
+                traceback.print_exc()
+                attempts = max(attempts for logEntry, attempts in group)
+                if self.__permanentError(error) or attempts + 1 >= self.journalMaxAttempts:
+                    for logEntry in logEntries:
+                        database.add(logEntry['id'])
+                        database.unjournal(logEntry['id'])
+                    metrics.increment('tart_log_entries_dropped_total', 'Log entries dropped from the journal as '
+                                      'they failed permanently.', len(logEntries))
+                    return
+                failed.add(incidentId)
+                retryAt = time.time() + min(self.journalRetrySeconds * 2 ** attempts, self.journalMaxRetrySeconds)
+                for logEntry in logEntries:
+                    database.retryJournaled(logEntry['id'], retryAt)
+                metrics.increment('tart_log_entries_retried_total', 'Log entries failed to be retried later.',
+                                  len(logEntries))
+                return
+            self.__addProcessed(database, logEntries)
+            for logEntry in logEntries:
+                database.unjournal(logEntry['id'])
+            if len(logEntries) > 1:
+                metrics.increment('tart_log_entries_coalesced_total', 'Log entries processed together with the '
+                                  'ones before them of the same incident.', len(logEntries) - 1)
+            budget.spend(types, time.time() - startedAt)
+            count += len(logEntries)
+
+        journaled = list(journaledLogEntries())
+        self.__createStormIssues([logEntry for logEntry, attempts in journaled], workers)
+        if seconds:
+            groups = coalesced(journaled, lambda item: item[0]['incident']['id'],
+                               lambda item: self.__timestamp(item[0]['created_at']), seconds)
+        else:
+            groups = ([item] for item in journaled)
+
+        deferred = set()
+        try:
+            for group in groups:
+                if pipeline.error:
+                    break
+                incidentId = group[0][0]['incident']['id']
+                types = [logEntry['type'] for logEntry, attempts in group]
+                if incidentId in deferred or (budget.reserved() and all(map(self.__rules.deferrable, types))):
+                    deferred.add(incidentId)
+                    metrics.increment('tart_log_entries_deferred_total', 'Log entries deferred to the next run.',
+                                      len(group))
+                    continue
+                if not budget.allows(types, pipeline.waiting(), workers):
+                    metrics.increment('tart_checks_out_of_budget_total', 'Checks stopped as their budgets ran out.',
+                                      check='pagerduty')
                     break
-                self.__processLogEntry(logEntry)
-                database.write(logEntry['created_at'])
+                pipeline.submit(incidentId, partial(committed, processGroup, group, types))
+        finally:
+            pipeline.close()
+
+        if pipeline.error:
+            raise pipeline.error
+        return count
+
+    '''Client errors which would fail the same way again. The others like 401, 403 and 408 can come while the
+    Jira is unhealthy, they are retried.'''
+    journalPermanentCodes = (400, 422)
+
+    def __permanentError(self, error):
+        return isinstance(error, HTTPError) and error.code in self.journalPermanentCodes
 
     checkJiraTimestampFile = '/tmp/tart-integration.jira.ts'
 
     def checkJira(self):
-        with TimestampDatabase(self.checkJiraTimestampFile) as database:
-            for issue in self.__jira.updatedIssues(self.__serviceConfig.sectionValues('project', 'issuetype'),
-                                                   database.read()):
-                for remotelink in issue.getUnresolvedRemotelinks():
-                    for action in self.__actionConfig.sections():
-                        if self.__matchAction(action, issue):
-                            incident = self.__pagerDuty.getIncident(remotelink['globalId'])
-
-                            if incident['status'] != self.__incidentStatus(action):
-                                incident.put(action)
-
-                database.write(issue['fields']['updated'])
-
-    def __matchAction(self, action, issue):
-        if self.__actionConfig.filter(action, 'match-status', issue['fields']['status']['name']):
-            return True
-        if self.__actionConfig.filter(action, 'match-priority', issue['fields']['priority']['name']):
-            return True
-        return False
+        '''Update the incidents of the updated issues, return the number of the issues. Statuses of the incidents
+        are got again on every check.'''
+        self.__pagerDuty.clearIncidents()
+        try:
+            return self.__checkJira()
+        except Leased:
+            return 0
+        finally:
+            self.__jira.userCache.save()
+            self.exportMetrics()
+
+    checkJiraBudgetSeconds = 300
+
+    checkJiraWorkers = 1
+
+    def __checkJira(self):
+        '''Process the updated issues until the budget of the run runs out, different issues in parallel by the
+        workers. Write the cursor to the last issue which is processed after all of the ones before it. The search
+        is precise to the minute, so the issues updated before the cursor are skipped, and the ones processed at
+        the same update. Only the issues created or changed their statuses or priorities since the cursor update
+        their incidents, by their changelogs.'''
+        budget = self.__budget(self.__integrationConfig.getfloat('Jira', 'budget-seconds',
+                                                                 fallback=self.checkJiraBudgetSeconds))
+        changelog = self.__integrationConfig.getboolean('Jira', 'changelog', fallback=True)
+        workers = self.__integrationConfig.getint('Jira', 'workers', fallback=self.checkJiraWorkers)
+        pipeline = KeyedPipeline(workers)
+
+        def processIssue(issue, since, version):
+            startedAt = time.time()
+            changed = issue.changed(since, ('status', 'priority'))
+            if not changed:
+                metrics.increment('tart_issues_unchanged_total', 'Updated issues without changes of their '
+                                  'statuses or priorities.')
+            self.__processIssue(issue, changed)
+            database.add(version)
+            budget.spend(['issue'], time.time() - startedAt)
+            metrics.increment('tart_issues_checked_total', 'Updated issues checked for the incidents.')
+
+        count = 0
+        with self.__budgeted(budget), self.__stateDatabase('jira', self.checkJiraTimestampFile) as database:
+            self.__bootstrapLinks()
+            since = database.read()
+            try:
+                for issue in self.__jira.updatedIssues(self.__rules.projectIssuetypes, since, changelog):
+                    if pipeline.error:
+                        break
+                    version = str(issue) + '@' + issue['fields']['updated']
+                    if issue['fields']['updated'] < since or database.processed(version):
+                        continue
+                    if not budget.allows(['issue'], pipeline.waiting(), workers):
+                        metrics.increment('tart_checks_out_of_budget_total', 'Checks stopped as their budgets ran '
+                                          'out.', check='jira')
+                        break
+                    pipeline.submit(str(issue), partial(processIssue, issue, since, version),
+                                    (issue['fields']['updated'], str(issue)))
+                    count += 1
+
+                    cursor = pipeline.watermark()
+                    if cursor:
+                        database.write(*cursor)
+            finally:
+                pipeline.close()
+                cursor = pipeline.watermark()
+                if cursor:
+                    database.write(*cursor)
+
+        if pipeline.error:
+            raise pipeline.error
+        return count
+
+    def __processIssue(self, issue, changed=True):
+        '''Update the incidents linked to the issue if the issue matches the actions, unless its status and
+        priority have not changed.'''
+        actions = ()
+        if changed:
+            actions = self.__rules.matchingActions(issue['fields']['status']['name'],
+                                                   issue['fields']['priority']['name'])
+        if actions:
+            for incident in self.__pagerDuty.getIncidents(self.__links.incidents(str(issue))):
+                with self.__incidentLock(str(incident)):
+                    for action in actions:
+                        if incident['status'] != self.__incidentStatus(action):
+                            if incident.put(action):
+                                metrics.increment('tart_incidents_updated_total', 'Incidents updated by the '
+                                                  'action.', action=action)
+
+        if issue['fields']['status']['name'] == 'Closed':
+            self.__links.forget(str(issue))
+        elif 'summary' in issue['fields']:
+            self.__indexIssue(issue)
+
+    def __incidentLock(self, incidentId):
+        '''Return the lock to update the incident by one issue at a time.'''
+        with self.__incidentLocksLock:
+            return self.__incidentLocks.setdefault(incidentId, threading.Lock())
+
+    def webhookLogEntries(self, payload):
+        return list(self.__pagerDuty.webhookLogEntries(payload))
+
+    def webhookIssue(self, payload):
+        '''Return the issue of the Jira webhook if it is one of the issues of the services.'''
+        issue = self.__jira.webhookIssue(payload)
+        if issue:
+            projectIssuetype = issue['fields']['project']['key'], issue['fields']['issuetype']['name']
+            if projectIssuetype in self.__rules.projectIssuetypes:
+                return issue
+
+    '''Seconds to keep the incidents cached between the webhooks, which come more often than the checks.'''
+    webhookIncidentsSeconds = 60
+
+    def processLogEntries(self, logEntries):
+        '''Journal the log entries received from the webhooks unless they were processed or journaled, and drain
+        the journal. The cursor is not moved, the next check will get the same events and skip them. Return the
+        number of the processed ones.'''
+        self.__pagerDuty.expireIncidents(self.webhookIncidentsSeconds)
+        count = 0
+        shards = {}
+        for logEntry in logEntries:
+            shards.setdefault(self.__shard(logEntry) if self.__shards > 1 else None, []).append(logEntry)
+        for shard, logEntries in shards.items():
+            budget = self.__budget(self.checkPagerDutyBudgetSeconds)
+            try:
+                with self.__stateDatabase(self.__shardName(shard), self.checkPagerDutyTimestampFile,
+                                          'pagerduty') as database:
+                    for logEntry in logEntries:
+                        if not self.__processed(database, logEntry) and not database.journaled(logEntry['id']):
+                            self.__journal(database, logEntry)
+                with self.__budgeted(budget), self.__journalDatabase(shard) as database:
+                    count += self.__drainJournal(database, budget)
+            except Leased:
+                '''The worker checking the shard will get them.'''
+                continue
+        return count
+
+    def processIssues(self, issues):
+        '''Update the incidents of the issues received from the webhooks.'''
+        self.__pagerDuty.expireIncidents(self.webhookIncidentsSeconds)
+        for issue in issues:
+            self.__processIssue(issue)
+        return len(issues)
+
+    async def checkConcurrently(self):
+        '''Run both checks at the same time on the event loop to overlap their waits for the network. Independent
+        requests of the log entries are made concurrently on the loop too. Return the number of the processed
+        items.'''
+        self.__loop = asyncio.get_running_loop()
+        self.__asyncJira = AsyncClient(self.__jira)
+        try:
+            with ThreadPoolExecutor(2) as executor:
+                return sum(await asyncio.gather(self.__loop.run_in_executor(executor, self.checkPagerDuty),
+                                                self.__loop.run_in_executor(executor, self.checkJira)))
+        finally:
+            self.__loop = None
 
     def __incidentStatus(self, action):
         if action == 'resolve':
@@ -70,71 +604,184 @@ class PagerDutyJira:
             return 'acknowledged'
         return 'triggered'
 
-    def __processLogEntry(self, logEntry):
-        '''Process incidents with the log entry and the incident related to the log entry.'''
-        if not self.__serviceConfig.has_section(logEntry['service']['name']):
+    def __processLogEntries(self, logEntries):
+        '''Process the log entries of the same incident with their net effect. The issue is created once, the last
+        transition is posted with the last assignee and the comments of all of the log entries combined, and the
+        issue is linked once. Combined comments are posted even if the transition is not available to keep the
+        history.'''
+        service = self.__rules.services.get(logEntries[0]['service']['name'])
+        if not service:
             return
 
-        if not self.__actionConfig.has_section(logEntry['type']):
+        actionEntries = [(self.__rules.actions[logEntry['type']], logEntry) for logEntry in logEntries
+                         if logEntry['type'] in self.__rules.actions]
+        if not actionEntries:
             return
+        action = self.__rules.netAction(action.name for action, logEntry in actionEntries)
+        logEntry = actionEntries[-1][1]
 
-        projectKey = self.__serviceConfig.get(logEntry['service']['name'], 'project')
-        issuetypeName = self.__serviceConfig.get(logEntry['service']['name'], 'issuetype')
+        projectKey = service.project
+        issuetypeName = service.issuetype
         incident = logEntry.incident()
-        issue = self.__findIssue(projectKey, issuetypeName, incident['trigger_summary_data'])
+        issue, transition = self.__lookup(logEntry, action, projectKey, issuetypeName, incident)
 
         if not issue and incident['status'] != 'resolved':
             '''Do not create issues for incidents already resolved on the PagerDuty. It is too late for them.'''
 
-            if self.__actionConfig.check(logEntry['type'], 'create'):
-                fields = {}
-                fields['project'] = {'key': projectKey}
-                fields['issuetype'] = self.__jira.issuetype(issuetypeName)
-                fields['summary'] = self.__issueSummary(incident['trigger_summary_data'])
-                fields['description'] = self.__description(logEntry['channel'])
-
-                jiraUser = self.__jira.getUser(incident['assigned_to_user']['email'])
-                if jiraUser:
-                    fields['assignee'] = jiraUser
-
-                if self.__serviceConfig.has_option(logEntry['service']['name'], 'create-priority'):
-                    priorityName = self.__serviceConfig.get(logEntry['service']['name'], 'create-priority')
-                    fields['priority'] = self.__jira.priority(priorityName)
-
+            if action.create:
+                creatingEntry = next(logEntry for action, logEntry in actionEntries if action.create)
+                fields = self.__issueFields(service, incident, creatingEntry)
                 issue = self.__jira.createIssue(fields)
+                self.__created(issue, incident, service, fields)
 
         if issue:
-            if self.__actionConfig.has_option(logEntry['type'], 'transition'):
-                transition = issue.getTransition(self.__actionConfig.get(logEntry['type'], 'transition'))
+            '''Fold the assignee and the comment to the transition, or to a single edit without a transition.'''
+            comment = '\n\n'.join(self.__generateComment(logEntry) for action, logEntry in actionEntries
+                                    if action.comment or action.transition)
+            assignee = None
+            if action.assign:
+                assignedUser = [logEntry['assigned_user'] for action, logEntry in actionEntries if action.assign][-1]
+                assignee = self.__jira.getUser(assignedUser['email'])
+
+            if action.transition:
+                if not transition:
+                    transition = issue.getTransition(action.transition, projectKey, issuetypeName)
                 if transition:
-                    issue.postTransition(transition, self.__generateComment(logEntry))
-
-            if self.__actionConfig.check(logEntry['type'], 'assign'):
-                jiraUser = self.__jira.getUser(logEntry['assigned_user']['email'])
-                if jiraUser:
-                    issue.putAssignee(jiraUser)
-
-            if self.__actionConfig.check(logEntry['type'], 'comment'):
-                issue.postComment(self.__generateComment(logEntry))
-
-            if self.__actionConfig.check(logEntry['type'], 'link'):
+                    fields = self.__postTransition(issue, transition, comment,
+                                                   {'assignee': assignee} if assignee else {})
+                    if fields is not None:
+                        metrics.increment('tart_issues_transitioned_total', 'Issues transitioned.',
+                                          transition=str(transition))
+                        comment = None
+                        if fields:
+                            assignee = None
+
+            commenting = action.comment or len(actionEntries) > 1
+            if assignee and commenting and comment:
+                if issue.edit({'assignee': assignee}, comment):
+                    assignee = comment = None
+
+            if assignee:
+                issue.putAssignee(assignee)
+
+            if commenting and comment:
+                issue.postComment(comment)
+
+            if action.link:
                 issue.postRemotelink(str(incident), url = incident['html_url'],
                         title = 'Incident #' + str(incident['incident_number']),
                         status = {'resolved': incident['status'] == 'resolved'})
+                self.__links.link(str(incident), str(issue), incident['status'] == 'resolved')
+
+    def __issueFields(self, service, incident, logEntry):
+        fields = {}
+        fields['project'] = {'key': service.project}
+        fields['issuetype'] = self.__jira.issuetype(service.issuetype)
+        fields['summary'] = self.__issueSummary(incident['trigger_summary_data'])
+        fields['description'] = self.__description(logEntry['channel'])
+
+        jiraUser = self.__jira.getUser(incident['assigned_to_user']['email'])
+        if jiraUser:
+            fields['assignee'] = jiraUser
+
+        if service.createPriority:
+            fields['priority'] = self.__jira.priority(service.createPriority)
+        return fields
+
+    def __created(self, issue, incident, service, fields):
+        '''Keep the issue created for the incident to be found by the following log entries.'''
+        metrics.increment('tart_issues_created_total', 'Issues created.', project=service.project)
+        self.__links.create(str(incident), str(issue))
+        self.__links.index(str(issue), service.project, service.issuetype, fields['summary'],
+                           time.strftime('%Y-%m-%dT%H:%M:%S.000+0000', time.gmtime()))
+
+    def __postTransition(self, issue, transition, comment, fields):
+        '''Post the transition with the fields. Fall back to get the transition again, as the cached one may not
+        be valid anymore for the issue, and to post it without the fields, as they may not be on the screen of the
+        transition. Return the fields posted, or None if the transition is not available.'''
+        try:
+            issue.postTransition(transition, comment, fields)
+            return fields
+        except HTTPError as error:
+            if error.code != 400:
+                raise
+
+        transition = issue.getTransition(str(transition))
+        if not transition:
+            return None
+        issue.postTransition(transition, comment)
+        return {}
+
+    def __lookup(self, logEntry, action, projectKey, issuetypeName, incident):
+        '''Find the issue and its transition for the log entry. When running on the event loop, find them while
+        looking up the users of the log entry concurrently to have them cached for the following steps.'''
+        if not self.__loop:
+            return self.__findIssue(projectKey, issuetypeName, incident), None
+        return asyncio.run_coroutine_threadsafe(self.__lookupConcurrently(logEntry, action, projectKey,
+                                                                          issuetypeName, incident),
+                                                self.__loop).result()
+
+    async def __lookupConcurrently(self, logEntry, action, projectKey, issuetypeName, incident):
+        async def findIssue():
+            issue = await self.__asyncJira.run(self.__findIssue, projectKey, issuetypeName, incident)
+            if issue and action.transition:
+                return issue, await self.__asyncJira.run(issue.getTransition, action.transition, projectKey,
+                                                         issuetypeName)
+            return issue, None
+
+        users = []
+        if action.create and 'assigned_to_user' in incident:
+            users.append(incident['assigned_to_user'])
+        for key in 'assigned_user', 'user', 'agent':
+            if key in logEntry and logEntry[key].get('email'):
+                users.append(logEntry[key])
+        emails = set(user['email'] for user in users)
+
+        results = await asyncio.gather(findIssue(), *(self.__asyncJira.getUser(email) for email in emails))
+        return results[0]
 
     issueSummarySplitters = ['\t', ' - ']
 
-    def __findIssue(self, projectKey, issuetypeName, summary):
-        issueSummary = self.__issueSummary(summary)
-        for splitter in self.issueSummarySplitters:
-            issueSummary = issueSummary.split(splitter, 1)[0]
+    def __findIssue(self, projectKey, issuetypeName, incident):
+        '''Look for the issue of the incident created in bulk, and on the link database first.'''
+        issue = self.__stormIssues.pop(str(incident), None)
+        if issue:
+            return issue
+
+        issueKey = self.__links.issue(str(incident))
+        if issueKey:
+            return Issue(self.__jira, {'key': issueKey})
+
+        issueSummary = self.__matchingSummary(incident)
 
         '''First, search by the issue key on the subject. It is usefull for incidents created by Jira emails.
         Issue type does not matter.'''
         issueKeys = re.findall(projectKey + '-[0-9]{1,6}', issueSummary)
         if issueKeys:
             return Issue(self.__jira, {'key': issueKeys[0]})
-        return self.__jira.searchIssue(projectKey, issuetypeName, issueSummary)
+
+        '''Then, match the summary on the index of the open issues. Search only if it is not there, and not searched
+        without a result since the index has changed.'''
+        issueKey = self.__links.match(projectKey, issuetypeName, issueSummary)
+        metrics.increment('tart_issue_matches_total', 'Issues matched by the summaries.', found=bool(issueKey),
+                          on='index')
+        if issueKey:
+            return Issue(self.__jira, {'key': issueKey})
+        if self.__links.unmatched(projectKey, issuetypeName, issueSummary):
+            return None
+
+        issue = self.__jira.searchIssue(projectKey, issuetypeName, issueSummary)
+        metrics.increment('tart_issue_matches_total', 'Issues matched by the summaries.', found=bool(issue),
+                          on='search')
+        if not issue:
+            self.__links.setUnmatched(projectKey, issuetypeName, issueSummary)
+        return issue
+
+    def __matchingSummary(self, incident):
+        issueSummary = self.__issueSummary(incident['trigger_summary_data'])
+        for splitter in self.issueSummarySplitters:
+            issueSummary = issueSummary.split(splitter, 1)[0]
+        return issueSummary
 
     def __issueSummary(self, summary):
         if 'SERVICESTATE' in summary and summary['SERVICESTATE']:
@@ -14,13 +14,27 @@
 # performance of this software.
 ##
 
+import os
+import zlib
 import configparser
+from types import MappingProxyType
+from collections import namedtuple
 
 class ConfigParser(configparser.SafeConfigParser):
     def __init__(self, filename, *args, **kwargs):
         configparser.SafeConfigParser.__init__(self, *args, **kwargs)
+        self.filename = filename
+        self.__modifiedAt = self.__modificationTime()
         self.read(filename)
 
+    def __modificationTime(self):
+        if os.path.exists(self.filename):
+            return os.path.getmtime(self.filename)
+
+    def changed(self):
+        '''Return true if the file has been modified since it was read.'''
+        return self.__modificationTime() != self.__modifiedAt
+
     def check(self, section, option):
         if self.has_option(section, option):
             return self.getboolean(section, option)
@@ -32,3 +46,96 @@ class ConfigParser(configparser.SafeConfigParser):
     def sectionValues(self, *keys):
         return ((self.get(section, key) for key in keys) for section in self.sections())
 
+
+Action = namedtuple('Action', ('name', 'create', 'transition', 'link', 'assign', 'comment', 'matchStatuses',
+                               'matchPriorities'))
+
+Service = namedtuple('Service', ('name', 'project', 'issuetype', 'createPriority', 'shard'))
+
+class Rules:
+    '''Action and service configurations compiled to immutable lookup tables not to parse the options for every
+    log entry and issue. Actions matching the issue statuses and priorities are kept in the order of the sections
+    like the configuration.'''
+
+    def __init__(self, actionConfig, serviceConfig):
+        actions = []
+        for section in actionConfig.sections():
+            actions.append(Action(section, bool(actionConfig.check(section, 'create')),
+                                  actionConfig.get(section, 'transition', fallback=None),
+                                  bool(actionConfig.check(section, 'link')),
+                                  bool(actionConfig.check(section, 'assign')),
+                                  bool(actionConfig.check(section, 'comment')),
+                                  self.__values(actionConfig, section, 'match-status'),
+                                  self.__values(actionConfig, section, 'match-priority')))
+        self.actions = MappingProxyType(dict((action.name, action) for action in actions))
+
+        statusActions = {}
+        priorityActions = {}
+        for action in actions:
+            for status in action.matchStatuses:
+                statusActions[status] = statusActions.get(status, ()) + (action.name,)
+            for priority in action.matchPriorities:
+                priorityActions[priority] = priorityActions.get(priority, ()) + (action.name,)
+        self.__statusActions = MappingProxyType(statusActions)
+        self.__priorityActions = MappingProxyType(priorityActions)
+        self.__order = MappingProxyType(dict((action.name, order) for order, action in enumerate(actions)))
+        self.__matchingActions = {}
+
+        self.services = MappingProxyType(dict((section, Service(section, serviceConfig.get(section, 'project'),
+                                                                serviceConfig.get(section, 'issuetype'),
+                                                                serviceConfig.get(section, 'create-priority',
+                                                                                  fallback=None),
+                                                                serviceConfig.getint(section, 'shard',
+                                                                                     fallback=None)))
+                                              for section in serviceConfig.sections()))
+        self.projectIssuetypes = tuple(sorted(set((service.project, service.issuetype)
+                                                  for service in self.services.values())))
+
+    def __values(self, config, section, option):
+        if config.has_option(section, option):
+            return frozenset(value.strip() for value in config.get(section, option).split(','))
+        return frozenset()
+
+    def matchingActions(self, status, priority):
+        '''Return the names of the actions matching the issue status or priority. Results are kept for the
+        combinations.'''
+        try:
+            return self.__matchingActions[status, priority]
+        except KeyError:
+            self.__matchingActions[status, priority] = self.__matchActions(status, priority)
+            return self.__matchingActions[status, priority]
+
+    def __matchActions(self, status, priority):
+        statusActions = self.__statusActions.get(status, ())
+        priorityActions = self.__priorityActions.get(priority, ())
+        if not priorityActions:
+            return statusActions
+        if not statusActions:
+            return priorityActions
+        return tuple(sorted(set(statusActions + priorityActions), key=self.__order.__getitem__))
+
+    def netAction(self, names):
+        '''Return the action with the net effect of the actions in order: the last transition, and the other
+        steps of any of them. A single action is returned as it is.'''
+        actions = [self.actions[name] for name in names]
+        if len(actions) == 1:
+            return actions[0]
+        transitions = [action.transition for action in actions if action.transition]
+        return Action(actions[-1].name, any(action.create for action in actions),
+                      transitions[-1] if transitions else None, any(action.link for action in actions),
+                      any(action.assign for action in actions), any(action.comment for action in actions),
+                      frozenset(), frozenset())
+
+    def deferrable(self, name):
+        '''Return true if the action of the log entry type only comments on the issues. They can be deferred after
+        the others when there is not enough time.'''
+        action = self.actions.get(name)
+        return bool(action and action.comment and not (action.create or action.transition or action.link or
+                                                       action.assign))
+
+    def shardServices(self, shard, shards):
+        '''Return the names of the services of the shard. Services are assigned to the shards by the hash of their
+        names unless the shard is configured.'''
+        return frozenset(service.name for service in self.services.values()
+                         if (service.shard if service.shard is not None else zlib.crc32(service.name.encode('utf-8')))
+                            % shards == shard)
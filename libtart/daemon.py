@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+##
+# Tart Integration
+#
+# Copyright (c) 2013, Tart İnternet Teknolojileri Ticaret AŞ
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose with or without fee is hereby
+# granted, provided that the above copyright notice and this permission notice appear in all copies.
+#
+# The software is provided "as is" and the author disclaims all warranties with regard to the software including all
+# implied warranties of merchantability and fitness. In no event shall the author be liable for any special, direct,
+# indirect, or consequential damages or any damages whatsoever resulting from loss of use, data or profits, whether
+# in an action of contract, negligence or other tortious action, arising out of or in connection with the use or
+# performance of this software.
+##
+
+import signal
+import asyncio
+import threading
+import traceback
+
+from .configuration import ConfigParser
+from .metrics import metrics
+from .webhook import WebhookReceiver
+
+class Daemon:
+    '''Keep the checker resident to run the checks repeatedly. Wait the shortest interval after the checks with
+    activity, double it after the idle ones until the idle interval. Read the changed configurations before every
+    check. Stop on SIGTERM or SIGINT, the current check stops before its next item. Run both checks at the same
+    time on an event loop if concurrent. Receive the webhooks if a port configured, then run the checks only to
+    catch up the missed events on the longer interval.'''
+
+    interval = 5
+    idleInterval = 60
+    catchUpInterval = 300
+
+    def __init__(self, checker, concurrent=False):
+        self.__checker = checker
+        self.__concurrent = concurrent
+        config = ConfigParser('integration.conf')
+        self.__interval = config.getfloat('Daemon', 'interval', fallback=self.interval)
+        self.__idleInterval = config.getfloat('Daemon', 'idle-interval', fallback=self.idleInterval)
+        self.__stopped = threading.Event()
+        checker.stopped = self.__stopped
+        if config.has_option('Metrics', 'port'):
+            metrics.serve(config.getint('Metrics', 'port'), config.get('Metrics', 'address', fallback=None))
+        self.__receiver = None
+        if config.has_option('Webhook', 'port'):
+            self.__receiver = WebhookReceiver(checker, config.get('Webhook', 'token', fallback=None),
+                                              config.getint('Webhook', 'port'),
+                                              config.get('Webhook', 'address', fallback=None),
+                                              config.getint('Webhook', 'queue-size', fallback=None))
+            self.__interval = self.__idleInterval = config.getfloat('Webhook', 'catch-up-interval',
+                                                                    fallback=self.catchUpInterval)
+
+    def stop(self, *arguments):
+        self.__stopped.set()
+
+    def check(self):
+        '''Run the checks, return the number of the processed items. Errors are printed not to stop the daemon,
+        they count as idle to back off.'''
+        self.__checker.reload()
+        try:
+            if self.__concurrent:
+                return asyncio.run(self.__checker.checkConcurrently())
+            return self.__checker.checkPagerDuty() + self.__checker.checkJira()
+        except Exception:
+            traceback.print_exc()
+            return 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if self.__receiver:
+            self.__receiver.start()
+
+        interval = self.__interval
+        while not self.__stopped.is_set():
+            if self.check():
+                interval = self.__interval
+            else:
+                interval = min(interval * 2, self.__idleInterval)
+            self.__stopped.wait(interval)
+
+        if self.__receiver:
+            self.__receiver.stop()
@@ -14,55 +14,329 @@
 # performance of this software.
 ##
 
+import os
+import re
+import time
 import signal
 import fcntl
+import socket
+import sqlite3
+import threading
 from datetime import datetime
 
+from .metrics import metrics
+
 class Timeout (Exception): pass
 
-class TimestampDatabase:
-    '''Database to read and write only one timestamp in ISO format. Allow single user by block the file when used.
-    Set SIGALRM to enter the database. Initilize the database implicitly with current timestamp on first read.'''
+class Leased (Exception): pass
+
+class StateDatabase:
+    '''Database to keep the state of a check: the cursor as the timestamp in ISO format and the identifier of the
+    last entry, the entries processed recently to skip them when they come again, and the journal of the entries
+    to be processed. Allow single user of the check by blocking a file when used. Set SIGALRM to enter the database
+    on the main thread, the checks limit the time they keep it with their budgets. Changes are committed in batches
+    of entries or seconds, and when left. Initialize the cursor implicitly with the timestamp file of the previous
+    versions or with the current timestamp on first read.
+
+    Lease the check on the database instead of blocking the file if the lease seconds given, to be shared by the
+    processes on different hosts. Leases are renewed on commits, and taken over by the others when they expire.
+    Raise Leased when the check is leased by another one.
+
+    Lock the check by the lock name instead of the name if given. Users of the same state with different lock names
+    work at the same time, each of them commits its changes without waiting for the others.'''
+
+    commitEntries = 100
+    commitSeconds = 1
+    processedSeconds = 86400
 
-    def __init__(self, filename):
+    __locks = {}
+    __locksLock = threading.Lock()
+
+    @staticmethod
+    def owner():
+        '''Identify the process holding the leases.'''
+        return socket.gethostname() + ':' + str(os.getpid())
+
+    def __init__(self, filename, name, timestampFilename=None, leaseSeconds=None, initialName=None,
+                 journalMode='wal', lockName=None):
         self.__filename = filename
-        signal.signal(signal.SIGALRM, self.__timeoutRaiser)
+        self.__name = name
+        self.__lockName = lockName or name
+        self.__timestampFilename = timestampFilename
+        self.__leaseSeconds = leaseSeconds
+        self.__initialName = initialName
+        self.__journalMode = journalMode
+        with self.__locksLock:
+            self.__lock = self.__locks.setdefault((filename, self.__lockName), threading.Lock())
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGALRM, self.__timeoutRaiser)
 
     __enterTimeoutSeconds = 10
-    __openTimeoutSeconds = 300
+
+    def __alarm(self, seconds):
+        if threading.current_thread() is threading.main_thread():
+            signal.alarm(seconds)
 
     def __enter__(self):
-        self.__pointer = open(self.__filename, 'a+')
+        '''Lock the check for the other threads of the process first, as the file locks are per process.'''
         self.__databaseLocked = False
-        signal.alarm(self.__enterTimeoutSeconds)
-
-        fcntl.lockf(self.__pointer, fcntl.LOCK_EX) 
+        self.__alarm(self.__enterTimeoutSeconds)
+        startedAt = time.time()
+        self.__lock.acquire()
+        self.__pointer = None
+        try:
+            if not self.__leaseSeconds:
+                self.__pointer = open(self.__filename + '.' + self.__lockName + '.lock', 'a+')
+                fcntl.lockf(self.__pointer, fcntl.LOCK_EX)
+            self.__connect()
+            if self.__leaseSeconds:
+                self.__lease()
+        except BaseException:
+            if self.__pointer:
+                self.__pointer.close()
+            self.__lock.release()
+            self.__alarm(0)
+            raise
         self.__databaseLocked = True
-        signal.alarm(self.__openTimeoutSeconds)
+        metrics.observe('tart_state_lock_wait_seconds', 'Seconds waited to lock the state of the check.',
+                        time.time() - startedAt, check=self.__lockName)
+        self.__alarm(0)
+        self.__uncommitted = 0
+        self.__committedAt = time.time()
         return self
 
+    def __connect(self):
+        self.__connection = sqlite3.connect(self.__filename, timeout=60, check_same_thread=False)
+        self.__connectionLock = threading.Lock()
+        self.__connection.execute('pragma journal_mode = ' + self.__journalMode)
+        self.__connection.execute('pragma synchronous = normal')
+        self.__connection.execute('create table if not exists cursors (name text primary key, '
+                                  'timestamp text not null, entry text)')
+        self.__connection.execute('create table if not exists processed (name text not null, entry text not null, '
+                                  'processedAt real not null, primary key (name, entry))')
+        self.__connection.execute('create table if not exists leases (name text primary key, owner text not null, '
+                                  'expiresAt real not null)')
+        self.__connection.execute('create table if not exists journal (name text not null, entry text not null, '
+                                  'key text not null, content text not null, attempts integer not null default 0, '
+                                  'retryAt real not null default 0, primary key (name, entry))')
+        self.__connection.commit()
+
+    def __lease(self):
+        '''Take the lease unless another one holds it and it has not expired.'''
+        self.__connection.execute('begin immediate')
+        try:
+            for owner, expiresAt in self.__connection.execute('select owner, expiresAt from leases where name = ?',
+                                                              (self.__lockName,)):
+                if owner != self.owner() and expiresAt > time.time():
+                    raise Leased('Check ' + self.__lockName + ' is leased by ' + owner + '.')
+            self.__connection.execute('insert or replace into leases values (?, ?, ?)',
+                                      (self.__lockName, self.owner(), time.time() + self.__leaseSeconds))
+        except BaseException:
+            self.__connection.rollback()
+            self.__connection.close()
+            raise
+        self.__connection.commit()
+
     def __timeoutRaiser(self, *arguments):
         if not self.__databaseLocked:
             raise Timeout('Database could not locked.')
 
-        raise Timeout
+    def __execute(self, query, *parameters):
+        with self.__connectionLock:
+            return self.__connection.execute(query, parameters).fetchall()
 
     def read(self):
-        self.__pointer.seek(0)
-        value = self.__pointer.read().strip()
+        '''Return the timestamp of the cursor.'''
+        for timestamp, in self.__execute('select timestamp from cursors where name = ?', self.__name):
+            return timestamp
 
+        value = None
+        if self.__initialName:
+            for value, in self.__execute('select timestamp from cursors where name = ?', self.__initialName):
+                pass
+        if not value and self.__timestampFilename and os.path.exists(self.__timestampFilename):
+            with open(self.__timestampFilename) as pointer:
+                value = pointer.read().strip()
         if not value:
             value = datetime.utcnow().isoformat()
-            self.write(value)
+        self.write(value)
+        self.commit()
 
         return value
 
-    def write(self, value):
-        self.__pointer.seek(0)
-        self.__pointer.truncate()
-        return self.__pointer.write(value)
+    def processed(self, entry):
+        return bool(self.__execute('select 1 from processed where name = ? and entry = ?', self.__name, entry))
+
+    def add(self, entry):
+        '''Add the entry to the processed ones.'''
+        self.__execute('insert or replace into processed values (?, ?, ?)', self.__name, entry, time.time())
+        self.__changed()
+
+    def journal(self, entry, key, content):
+        '''Append the entry to the journal with the key to keep the order of the ones with the same key.'''
+        self.__execute('insert or ignore into journal (name, entry, key, content) values (?, ?, ?, ?)', self.__name,
+                       entry, key, content)
+        self.__changed()
+
+    def journaled(self, entry):
+        return bool(self.__execute('select 1 from journal where name = ? and entry = ?', self.__name, entry))
+
+    def journalEntries(self):
+        '''Return the entries on the journal as tuples of the entry, the key, the content, the attempts and the
+        time to retry in the order they are appended.'''
+        return self.__execute('select entry, key, content, attempts, retryAt from journal where name = ? '
+                              'order by rowid', self.__name)
+
+    def retryJournaled(self, entry, retryAt):
+        '''Count the failed attempt of the entry on the journal, and delay it until the time to retry.'''
+        self.__execute('update journal set attempts = attempts + 1, retryAt = ? where name = ? and entry = ?',
+                       retryAt, self.__name, entry)
+        self.__changed()
+
+    def unjournal(self, entry):
+        self.__execute('delete from journal where name = ? and entry = ?', self.__name, entry)
+        self.__changed()
+
+    def write(self, timestamp, entry=None):
+        '''Move the cursor.'''
+        self.__execute('insert or replace into cursors values (?, ?, ?)', self.__name, timestamp, entry)
+        self.__changed()
+
+    def __changed(self):
+        with self.__connectionLock:
+            self.__uncommitted += 1
+            if self.__uncommitted < self.commitEntries and time.time() - self.__committedAt < self.commitSeconds:
+                return
+        self.commit()
+
+    def commit(self):
+        '''Commit the changes with the renewed lease. Raise Leased if the lease has been taken over, the changes
+        of the other one should not be overwritten.'''
+        with self.__connectionLock:
+            if self.__leaseSeconds:
+                cursor = self.__connection.execute('update leases set expiresAt = ? where name = ? and owner = ?',
+                                                   (time.time() + self.__leaseSeconds, self.__lockName, self.owner()))
+                if not cursor.rowcount:
+                    self.__connection.rollback()
+                    raise Leased('Lease of the check ' + self.__lockName + ' is taken over.')
+            self.__connection.commit()
+            self.__uncommitted = 0
+            self.__committedAt = time.time()
 
     def __exit__(self, *arguments):
-        self.__pointer.close()
-        signal.alarm(0)
+        try:
+            try:
+                self.__execute('delete from processed where name = ? and processedAt < ?', self.__name,
+                               time.time() - self.processedSeconds)
+                self.commit()
+                if self.__leaseSeconds:
+                    self.__execute('delete from leases where name = ? and owner = ?', self.__lockName,
+                                   self.owner())
+                    self.__connection.commit()
+            finally:
+                self.__connection.close()
+        finally:
+            if self.__pointer:
+                self.__pointer.close()
+            self.__lock.release()
+
+class LinkDatabase:
+    '''Database to map the incidents to the issues. Incidents are linked when the remote links are posted to the
+    issues. Kept on SQLite to be shared by the threads and the processes. Summaries of the open issues are indexed
+    by their words to match them locally instead of searching. Summaries searched without a result are kept in
+    memory until an issue with their words is indexed.'''
+
+    def __init__(self, filename, journalMode='wal'):
+        self.__connection = sqlite3.connect(filename, timeout=60, isolation_level=None, check_same_thread=False)
+        self.__lock = threading.Lock()
+        self.__unmatched = {}
+        with self.__lock:
+            self.__connection.execute('pragma journal_mode = ' + journalMode)
+            self.__connection.execute('create table if not exists links (incident text primary key, '
+                                      'issue text not null, linked integer not null, resolved integer not null)')
+            self.__connection.execute('create index if not exists linksByIssue on links (issue)')
+            self.__connection.execute('create table if not exists properties (name text primary key, value text)')
+            self.__connection.execute('create table if not exists summaries (issue text primary key, '
+                                      'project text not null, issuetype text not null, updated text not null)')
+            self.__connection.execute('create table if not exists summaryWords (word text not null, '
+                                      'issue text not null, primary key (word, issue))')
+            self.__connection.execute('create index if not exists summaryWordsByIssue on summaryWords (issue)')
+
+    def __execute(self, query, *parameters):
+        with self.__lock:
+            return self.__connection.execute(query, parameters).fetchall()
+
+    def bootstrapped(self, name='bootstrapped'):
+        return bool(self.__execute('select value from properties where name = ?', name))
+
+    def setBootstrapped(self, name='bootstrapped'):
+        self.__execute('insert or replace into properties values (?, ?)', name, datetime.utcnow().isoformat())
+
+    def issue(self, incident):
+        '''Return the issue key of the incident or None.'''
+        for issue, in self.__execute('select issue from links where incident = ?', incident):
+            return issue
+
+    def incidents(self, issue):
+        '''Return the incidents linked to the issue and not resolved.'''
+        return [incident for incident, in self.__execute('select incident from links where issue = ? and linked '
+                                                         'and not resolved', issue)]
+
+    def create(self, incident, issue):
+        '''Add the incident of the issue just created, it will be linked later.'''
+        self.__execute('insert or ignore into links values (?, ?, 0, 0)', incident, issue)
+
+    def link(self, incident, issue, resolved):
+        self.__execute('insert or replace into links values (?, ?, 1, ?)', incident, issue, int(resolved))
+
+    def forget(self, issue):
+        '''Remove the incidents and the summary of the closed issue not to find it for them again like the
+        searches.'''
+        self.__execute('delete from links where issue = ?', issue)
+        self.unindex(issue)
+
+    @staticmethod
+    def words(summary):
+        return set(re.findall(r'\w+', summary.lower()))
+
+    def index(self, issue, project, issuetype, summary, updated):
+        '''Index the summary of the open issue, replacing the old one.'''
+        words = self.words(summary)
+        with self.__lock:
+            for key, unmatchedWords in list(self.__unmatched.items()):
+                if key[:2] == (project, issuetype) and unmatchedWords <= words:
+                    del self.__unmatched[key]
+            self.__connection.execute('begin')
+            try:
+                self.__connection.execute('insert or replace into summaries values (?, ?, ?, ?)',
+                                          (issue, project, issuetype, updated))
+                self.__connection.execute('delete from summaryWords where issue = ?', (issue,))
+                self.__connection.executemany('insert into summaryWords values (?, ?)',
+                                              ((word, issue) for word in words))
+            except BaseException:
+                self.__connection.execute('rollback')
+                raise
+            self.__connection.execute('commit')
+
+    def unmatched(self, project, issuetype, summary):
+        return (project, issuetype, summary) in self.__unmatched
+
+    def setUnmatched(self, project, issuetype, summary):
+        with self.__lock:
+            self.__unmatched[project, issuetype, summary] = self.words(summary)
+
+    def unindex(self, issue):
+        self.__execute('delete from summaries where issue = ?', issue)
+        self.__execute('delete from summaryWords where issue = ?', issue)
 
+    def match(self, project, issuetype, summary):
+        '''Return the key of the open issue updated last with all of the words of the summary like the search
+        of the Jira, or None.'''
+        words = self.words(summary)
+        if not words:
+            return None
+        query = 'select summaries.issue from summaries join summaryWords on summaryWords.issue = summaries.issue '
+        query += 'where project = ? and issuetype = ? and word in (' + ', '.join('?' * len(words)) + ') '
+        query += 'group by summaries.issue having count(*) = ? order by updated desc limit 1'
+        for issue, in self.__execute(query, project, issuetype, *(list(words) + [len(words)])):
+            return issue
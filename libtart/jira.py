@@ -14,16 +14,132 @@
 # performance of this software.
 ##
 
-from .api import JSONAPI
+import os
+import json
+import time
+import threading
+import traceback
+from collections import OrderedDict
+
+from .api import JSONAPI, prefetched
+
+class UserCache:
+    '''Cache users by their lowercase names or emails. Negative results are cached too, with a shorter lifetime, not
+    to search again for the people who does not have a user on the Jira. Least recently used users are dropped when
+    the cache is full, it is grown to hold all of the listed users on top of the size. The cache is saved to the file
+    in batches of changes and at the end of the runs, to be used by the following runs, if a filename given.'''
+
+    def __init__(self, filename=None, seconds=86400, negativeSeconds=3600, size=1000, saveChanges=100):
+        self.__filename = filename
+        self.__seconds = seconds
+        self.__negativeSeconds = negativeSeconds
+        self.__size = size
+        self.__saveChanges = saveChanges
+        self.__users = OrderedDict()
+        self.__listed = 0
+        self.__changes = 0
+        self.__warmedAt = 0
+        self.__lock = threading.RLock()
+        if filename and os.path.exists(filename):
+            self.__load()
+
+    def __load(self):
+        try:
+            with open(self.__filename) as pointer:
+                content = json.load(pointer)
+            self.__warmedAt = content['warmedAt']
+            self.__listed = content.get('listed', 0)
+            for key, expiresAt, user in content['users']:
+                self.__users[key] = expiresAt, user
+        except (ValueError, KeyError, TypeError):
+            '''Broken cache is not worth to fail for. It will be overwritten.'''
+            self.__users.clear()
+            self.__listed = 0
+            self.__warmedAt = 0
+
+    def save(self):
+        '''Write the cache to the file if it has changed since the last save.'''
+        if not self.__filename:
+            return
+        with self.__lock:
+            if not self.__changes:
+                return
+            content = {'warmedAt': self.__warmedAt, 'listed': self.__listed,
+                       'users': [[key, expiresAt, user] for key, (expiresAt, user) in self.__users.items()]}
+            temporaryFilename = self.__filename + '.' + str(os.getpid()) + '.tmp'
+            with open(temporaryFilename, 'w') as pointer:
+                json.dump(content, pointer)
+            os.replace(temporaryFilename, self.__filename)
+            self.__changes = 0
+
+    def lookup(self, key):
+        '''Return a tuple of a boolean for found and the user which is None for the negative results.'''
+        key = key.lower()
+        with self.__lock:
+            if key in self.__users:
+                expiresAt, user = self.__users[key]
+                if expiresAt > time.time():
+                    self.__users.move_to_end(key)
+                    return True, user
+                del self.__users[key]
+        return False, None
+
+    def __set(self, key, user):
+        seconds = self.__seconds if user else self.__negativeSeconds
+        self.__users[key.lower()] = time.time() + seconds, user
+        self.__users.move_to_end(key.lower())
+        while len(self.__users) > self.__size + self.__listed:
+            self.__users.popitem(last=False)
+        self.__changes += 1
+
+    def set(self, key, user):
+        with self.__lock:
+            self.__set(key, user)
+            if self.__changes < self.__saveChanges:
+                return
+        self.save()
+
+    def warmed(self):
+        return self.__warmedAt + self.__seconds > time.time()
+
+    def warm(self, users):
+        '''Add the users listed in bulk by their names and emails.'''
+        users = list(users)
+        with self.__lock:
+            self.__listed = len({key.lower() for user in users for key in (user['name'], user.get('emailAddress'))
+                                 if key})
+            for user in users:
+                self.__set(user['name'], user)
+                if user.get('emailAddress'):
+                    self.__set(user['emailAddress'], user)
+            self.__warmedAt = time.time()
+        self.save()
+
+    def postpone(self):
+        '''Do not list the users again until the negative results expire, after the listing failed.'''
+        with self.__lock:
+            self.__warmedAt = time.time() - self.__seconds + self.__negativeSeconds
 
 class JiraClient(JSONAPI):
+    validatedResources = ('issuetype', 'priority', 'issue/[^/]+/transitions')
+
+    def __init__(self, *args, **kwargs):
+        JSONAPI.__init__(self, *args, **kwargs)
+        self.userCache = UserCache()
+        self.__warmLock = threading.Lock()
+        self.__transitions = {}
+        self.__transitionsLock = threading.Lock()
+        self.__metadata = {}
+        self.__metadataLock = threading.Lock()
+
     def searchIssue(self, project, issuetype, summary):
         '''Search for name in the issue summaries which are not closed, return the one updated last.'''
         parameters = {}
         parameters['jql'] = 'project = "' + project + '" and issuetype = "' + issuetype + '" and '
-        parameters['jql'] += 'summary ~ "' + summary + '" and status != Closed order by updated'
+        parameters['jql'] += 'summary ~ "' + summary.replace('\\', '\\\\').replace('"', '\\"') + '" and '
+        parameters['jql'] += 'status != Closed order by updated'
         parameters['maxResults'] = 1
-        parameters['fields'] = 'key'
+        parameters['fields'] = 'key,status'
 
         result = self.get('search', parameters)
         if result['issues']:
@@ -31,50 +147,217 @@ class JiraClient(JSONAPI):
 
     maxUpdatedIssues = 100
 
-    def updatedIssues(self, projectIssuetypeTuples, since):
+    def __searchPages(self, parameters):
+        startAt = 0
+        while True:
+            result = self.get('search', dict(parameters, startAt=startAt))
+            yield result['issues']
+            startAt += len(result['issues'])
+            if not result['issues'] or startAt >= result['total']:
+                break
+
+    def __projectIssuetypeQuery(self, projectIssuetypeTuples):
+        return '(' + ' or '.join('(project = "' + project + '" and issuetype = "' + issuetype + '")'
+                for project, issuetype in projectIssuetypeTuples) + ')'
+
+    pageOverlap = 10
+
+    def __version(self, issue):
+        return issue['key'] + '@' + issue['fields']['updated']
+
+    def __updatedPages(self, parameters, since):
+        '''Get the pages of the issues updated since the minute by a moving cursor instead of the offsets, as the
+        issues updated while paging move to the end and shift the offsets. Every page is requested from the minute
+        of the last issue on the previous one, the issues seen on the previous pages at the same updates are left
+        out. Offsets are used only when a whole page is updated in the same minute. Those pages overlap, if the
+        first issue of one is not seen before, the issues before it have moved, so it is requested again from an
+        earlier offset.'''
+        query = parameters['jql']
+        minute = since.replace('T', ' ')[:16]
+        startAt = 0
+        seen = set()
+        while True:
+            parameters['jql'] = query.format(minute)
+            result = self.get('search', dict(parameters, startAt=startAt))
+            issues = result['issues']
+            if startAt and issues and self.__version(issues[0]) not in seen:
+                startAt = max(0, startAt - self.pageOverlap)
+                continue
+            yield [issue for issue in issues if self.__version(issue) not in seen]
+            if not issues or startAt + len(issues) >= result['total']:
+                break
+
+            lastMinute = issues[-1]['fields']['updated'].replace('T', ' ')[:16]
+            if lastMinute > minute:
+                minute = lastMinute
+                startAt = 0
+                seen = set(version for version in seen if version.split('@', 1)[1].replace('T', ' ') >= minute)
+            else:
+                startAt += max(1, len(issues) - self.pageOverlap)
+            seen.update(self.__version(issue) for issue in issues)
+
+    def updatedIssues(self, projectIssuetypeTuples, since, changelog=False):
+        '''Get updated issues in ascending order page by page, with their changelogs if wanted. Next page is
+        fetched while the current one is consumed. The query is precise to the minute, the issues updated in the
+        minute of the since are included. Issues updated again while paging may come again with the new
+        updates.'''
+        parameters = {}
+        parameters['jql'] = self.__projectIssuetypeQuery(projectIssuetypeTuples).replace('{', '{{').replace('}', '}}')
+        parameters['jql'] += ' and updated >= "{0}" order by updated asc'
+        parameters['maxResults'] = self.maxUpdatedIssues
+        parameters['fields'] = 'key,created,updated,status,priority,summary,project,issuetype'
+        if changelog:
+            parameters['expand'] = 'changelog'
+
+        for page in prefetched(self.__updatedPages(parameters, since)):
+            for r in page:
+                yield Issue(self, r)
+
+    def openIssues(self, projectIssuetypeTuples):
+        '''Get the issues which are not closed page by page.'''
         parameters = {}
-        parameters['jql'] = '(' + ' or '.join('(project = "' + project + '" and issuetype = "' + issuetype + '")'
-                for project, issuetype in projectIssuetypeTuples)
-        parameters['jql'] += ') and updated > "' + since.replace('T', ' ')[:16] + '" order by updated asc'
+        parameters['jql'] = self.__projectIssuetypeQuery(projectIssuetypeTuples) + ' and status != Closed order by key'
         parameters['maxResults'] = self.maxUpdatedIssues
-        parameters['fields'] = 'key,updated,status,priority'
+        parameters['fields'] = 'key,updated,summary,project,issuetype'
+
+        for page in prefetched(self.__searchPages(parameters)):
+            for r in page:
+                yield Issue(self, r)
+
+    metadataSeconds = 3600
 
-        return (Issue(self, r) for r in self.get('search', parameters)['issues'])
+    def __metadataItem(self, resource, name):
+        '''Get the list of the resource once in the seconds to find the items by their names.'''
+        with self.__metadataLock:
+            listedAt, items = self.__metadata.get(resource, (0, None))
+            if listedAt + self.metadataSeconds < time.time():
+                items = dict((item['name'], item) for item in self.get(resource))
+                self.__metadata[resource] = time.time(), items
+        return items.get(name)
 
     def issuetype(self, name):
-        for issuetype in self.get('issuetype'):
-            if name == issuetype['name']:
-                return issuetype
+        return self.__metadataItem('issuetype', name)
 
     def priority(self, name):
-        for priority in self.get('priority'):
-            if name == priority['name']:
-                return priority
+        return self.__metadataItem('priority', name)
+
+    def webhookIssue(self, payload):
+        '''Return the issue of a webhook of an issue event.'''
+        if payload.get('webhookEvent') in ('jira:issue_created', 'jira:issue_updated') and 'issue' in payload:
+            return Issue(self, payload['issue'])
+
+    initialStatus = 'Open'
 
     def createIssue(self, fields):
-        return Issue(self, self.post('issue', {'fields': fields}))
+        issue = Issue(self, self.post('issue', {'fields': fields}))
+        issue.status = self.initialStatus
+        return issue
+
+    maxBulkIssues = 50
+
+    def createIssues(self, fieldsList):
+        '''Create the issues in bulk, return them in the same order with None for the failed ones.'''
+        issues = []
+        for startAt in range(0, len(fieldsList), self.maxBulkIssues):
+            chunk = fieldsList[startAt:startAt + self.maxBulkIssues]
+            result = self.post('issue/bulk', {'issueUpdates': [{'fields': fields} for fields in chunk]})
+            failed = set(error['failedElementNumber'] for error in result.get('errors', []))
+            created = iter(result['issues'])
+            for number in range(len(chunk)):
+                issue = None
+                if number not in failed:
+                    issue = Issue(self, next(created))
+                    issue.status = self.initialStatus
+                issues.append(issue)
+        return issues
+
+    def cachedTransitions(self, project, issuetype, status):
+        '''Return the transitions cached for the status of the workflow of the project and the issue type, or the
+        ones seen on any status of it when the status is unknown. Transitions with the same names usually have
+        the same identifiers on all statuses of a workflow.'''
+        with self.__transitionsLock:
+            return self.__transitions.get((project, issuetype, status))
+
+    def cacheTransitions(self, project, issuetype, status, transitions):
+        with self.__transitionsLock:
+            if status:
+                self.__transitions[project, issuetype, status] = transitions
+            self.__transitions.setdefault((project, issuetype, None), {}).update(transitions)
 
     def getUser(self, name):
-        '''According to Jira 6.1 REST API documentation users can be searched by username, name or email.'''
+        '''According to Jira 6.1 REST API documentation users can be searched by username, name or email. Users are
+        listed in bulk to the cache before the first search unless they were listed recently.'''
+        found, user = self.userCache.lookup(name)
+        if found:
+            return user
+
+        with self.__warmLock:
+            if not self.userCache.warmed():
+                try:
+                    self.userCache.warm(self.listUsers())
+                except Exception:
+                    '''The users are searched one by one until the listing is tried again.'''
+                    traceback.print_exc()
+                    self.userCache.postpone()
+        found, user = self.userCache.lookup(name)
+        if found:
+            return user
+
         users = self.get('user/search', {'username': name, 'maxResults': 1})
-        if users:
-            return users[0]
+        user = users[0] if users else None
+        self.userCache.set(name, user)
+        return user
+
+    userListQuery = '.'
+    maxListedUsers = 1000
+
+    def listUsers(self):
+        '''List all active users page by page. The query matches all users as it matches the dots on their
+        emails.'''
+        startAt = 0
+        while True:
+            users = self.get('user/search', {'username': self.userListQuery, 'startAt': startAt,
+                                             'maxResults': self.maxListedUsers})
+            for user in users:
+                yield user
+            if len(users) < self.maxListedUsers:
+                break
+            startAt += len(users)
 
 class Issue(dict):
     def __init__(self, client, properties):
         self.__client = client
         dict.__init__(self, properties)
+        self.status = None
+        if 'fields' in self and 'status' in self['fields']:
+            self.status = self['fields']['status']['name']
 
     def __str__(self):
         return self['key']
 
-    def getUnresolvedRemotelinks(self):
+    def changed(self, since, fields):
+        '''Return true if the issue is created or any of the fields are changed at or after the since by the
+        changelog. Issues without the complete changelog are assumed to be changed.'''
+        if 'changelog' not in self or self['fields'].get('created', since) >= since:
+            return True
+        changelog = self['changelog']
+        if changelog.get('total', 0) > len(changelog['histories']):
+            return True
+        return any(history['created'] >= since and any(item['field'] in fields for item in history['items'])
+                   for history in changelog['histories'])
+
+    def getRemotelinks(self):
+        '''Get the remote links of our application.'''
         for remoteLink in self.__client.get('issue/' + self['key'] + '/remotelink'):
             if 'application' in remoteLink:
                 if 'type' in remoteLink['application']:
                     if remoteLink['application']['type'] == self.__client.application:
-                        if not remoteLink['object']['status']['resolved']:
-                            yield remoteLink
+                        yield remoteLink
+
+    def getUnresolvedRemotelinks(self):
+        for remoteLink in self.getRemotelinks():
+            if not remoteLink['object']['status']['resolved']:
+                yield remoteLink
 
     def postRemotelink(self, globalId, **kwargs):
         parameters = {}
@@ -84,17 +367,41 @@ class Issue(dict):
 
         return self.__client.post('issue/' + self['key'] + '/remotelink', parameters)
 
-    def getTransition(self, name):
-        for transition in self.__client.get('issue/' + self['key'] + '/transitions')['transitions']:
-            if transition['name'] == name:
-                return Transition(transition)
+    def getTransition(self, name, project=None, issuetype=None):
+        '''Get the transition from the cache of the workflow if the project and the issue type given. Cached ones
+        may not be valid anymore for the issue, the requests using them should fall back to get them again.'''
+        if project:
+            transitions = self.__client.cachedTransitions(project, issuetype, self.status)
+            if transitions is not None and (self.status or name in transitions):
+                return transitions.get(name)
 
-    def postTransition(self, transition, commentBody):
+        transitions = dict((transition['name'], Transition(transition))
+                           for transition in self.__client.get('issue/' + self['key'] + '/transitions')['transitions'])
+        if project:
+            self.__client.cacheTransitions(project, issuetype, self.status, transitions)
+        return transitions.get(name)
+
+    def postTransition(self, transition, commentBody, fields=None):
+        '''Transition the issue with the comment, and the fields to edit at the same time if given.'''
         parameters = {}
         parameters['transition'] = transition
         parameters['update'] = {'comment': [{'add': {'body': commentBody}}]}
+        if fields:
+            parameters['fields'] = fields
+
+        result = self.__client.post('issue/' + self['key'] + '/transitions', parameters)
+        if 'to' in transition:
+            self.status = transition['to']['name']
+        return result
+
+    def edit(self, fields, commentBody):
+        '''Edit the fields and add the comment with a single request. Return false if not allowed. It is not
+        retried, as the comment would be added again if the edit was applied before the failure.'''
+        parameters = {}
+        parameters['fields'] = fields
+        parameters['update'] = {'comment': [{'add': {'body': commentBody}}]}
 
-        return self.__client.post('issue/' + self['key'] + '/transitions', parameters)
+        return self.__client.put('issue/' + self['key'], parameters, idempotent=False) is not False
 
     def postComment(self, body):
         return self.__client.post('issue/' + self['key'] + '/comment', {'body': body})
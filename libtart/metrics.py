@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+##
+# Tart Integration
+#
+# Copyright (c) 2013, Tart İnternet Teknolojileri Ticaret AŞ
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose with or without fee is hereby
+# granted, provided that the above copyright notice and this permission notice appear in all copies.
+#
+# The software is provided "as is" and the author disclaims all warranties with regard to the software including all
+# implied warranties of merchantability and fitness. In no event shall the author be liable for any special, direct,
+# indirect, or consequential damages or any damages whatsoever resulting from loss of use, data or profits, whether
+# in an action of contract, negligence or other tortious action, arising out of or in connection with the use or
+# performance of this software.
+##
+
+import os
+import threading
+
+class Metrics:
+    '''Counters and histograms with labels to export in the Prometheus text format. Metrics are described on the
+    first use.'''
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+    '''Metrics are served only locally unless another address is given, they are not meant to be public.'''
+    address = '127.0.0.1'
+
+    def __init__(self):
+        self.__descriptions = {}
+        self.__counters = {}
+        self.__histograms = {}
+        self.__lock = threading.Lock()
+        self.__textfileLock = threading.Lock()
+
+    def __key(self, name, description, labels):
+        self.__descriptions.setdefault(name, description)
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, description, value=1, **labels):
+        with self.__lock:
+            key = self.__key(name, description, labels)
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, description, value, **labels):
+        with self.__lock:
+            key = self.__key(name, description, labels)
+            if key not in self.__histograms:
+                self.__histograms[key] = [0] * len(self.buckets) + [0, 0]
+            histogram = self.__histograms[key]
+            for number, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram[number] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def __labels(self, labels, *extra):
+        labels = labels + extra
+        if not labels:
+            return ''
+        return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                              for key, value in labels) + '}'
+
+    def text(self):
+        lines = []
+        with self.__lock:
+            for name in sorted(set(name for name, labels in self.__counters)):
+                lines.append('# HELP ' + name + ' ' + self.__descriptions[name])
+                lines.append('# TYPE ' + name + ' counter')
+                for (counterName, labels), value in sorted(self.__counters.items()):
+                    if counterName == name:
+                        lines.append(name + self.__labels(labels) + ' ' + repr(value))
+
+            for name in sorted(set(name for name, labels in self.__histograms)):
+                lines.append('# HELP ' + name + ' ' + self.__descriptions[name])
+                lines.append('# TYPE ' + name + ' histogram')
+                for (histogramName, labels), histogram in sorted(self.__histograms.items()):
+                    if histogramName == name:
+                        for bucket, count in zip(self.buckets, histogram):
+                            lines.append(name + '_bucket' + self.__labels(labels, ('le', repr(float(bucket)))) +
+                                         ' ' + str(count))
+                        lines.append(name + '_bucket' + self.__labels(labels, ('le', '+Inf')) + ' ' +
+                                     str(histogram[-1]))
+                        lines.append(name + '_sum' + self.__labels(labels) + ' ' + repr(histogram[-2]))
+                        lines.append(name + '_count' + self.__labels(labels) + ' ' + str(histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def writeTextfile(self, filename):
+        '''Write to a temporary file and rename it not to be read half written by the collector. Threads of the
+        process write one at a time, as they share the temporary file.'''
+        temporaryFilename = filename + '.' + str(os.getpid()) + '.tmp'
+        with self.__textfileLock:
+            with open(temporaryFilename, 'w') as pointer:
+                pointer.write(self.text())
+            os.replace(temporaryFilename, filename)
+
+    def serve(self, port, address=None):
+        '''Serve the metrics over HTTP on a daemon thread.'''
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = metrics.text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *arguments): pass
+
+        server = HTTPServer((address or self.address, int(port)), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+metrics = Metrics()
@@ -14,30 +14,149 @@
 # performance of this software.
 ##
 
-from .api import JSONAPI
+import time
+import threading
+from datetime import datetime
+
+from .api import JSONAPI, prefetched
 
 class PagerDutyClient(JSONAPI):
+    '''Incidents are cached to be get once. The ones included with the log entries and the ones updated are
+    cached too, so the cache mirrors the status of the incidents until it is cleared.'''
+
     includeWithLogEntry = ['incident', 'channel', 'service', 'note']
+    maxLogEntries = 100
+    maxIncidents = 100
 
-    def logEntries(self, since):
-        '''Get log entries. Return them reverse ordered as they come with right descending order.'''
-        logEntries = self.get('log_entries', {'since': since, 'include': self.includeWithLogEntry})['log_entries']
+    def __init__(self, *args, **kwargs):
+        JSONAPI.__init__(self, *args, **kwargs)
+        self.__incidents = {}
+        self.__openIncidentsListed = False
+        self.__incidentsLock = threading.Lock()
+        self.__listingLock = threading.Lock()
+        self.__clearedAt = time.time()
+
+    def clearIncidents(self):
+        with self.__incidentsLock:
+            self.__incidents.clear()
+            self.__openIncidentsListed = False
+            self.__clearedAt = time.time()
+
+    def expireIncidents(self, seconds):
+        '''Clear the cache if it is kept longer than the seconds.'''
+        with self.__incidentsLock:
+            expired = self.__clearedAt + seconds < time.time()
+        if expired:
+            self.clearIncidents()
+
+    def cacheIncident(self, properties):
+        incident = Incident(self, properties)
+        with self.__incidentsLock:
+            self.__incidents[incident['id']] = incident
+        return incident
+
+    def __logEntryPages(self, since):
+        '''Get log entries page by page from the oldest. They come in descending order, so the pages are requested
+        from the last one and reversed. End of the range is fixed not to shift the offsets with the new log entries
+        while iterating. The first page is requested to learn the total.'''
+        parameters = {}
+        parameters['since'] = since
+        parameters['until'] = datetime.utcnow().isoformat()
+        parameters['include'] = self.includeWithLogEntry
+        parameters['limit'] = self.maxLogEntries
+
+        firstPage = self.get('log_entries', dict(parameters, offset=0))
+        offset = (firstPage['total'] - 1) // self.maxLogEntries * self.maxLogEntries
+        while offset > 0:
+            yield reversed(self.get('log_entries', dict(parameters, offset=offset))['log_entries'])
+            offset -= self.maxLogEntries
+        yield reversed(firstPage['log_entries'])
 
-        for item in reversed(logEntries):
-            if item['created_at'] > since:
-                '''Double check the date to filter out equals.'''
+    def logEntries(self, since):
+        '''Get log entries in ascending order. Next page is fetched while the current one is consumed. The ones
+        created at the same time with the since are included, as the others created at the same time may not be
+        processed yet.'''
+        for item in (item for page in prefetched(self.__logEntryPages(since)) for item in page):
+            if item['created_at'] >= since:
+                '''Double check the date to filter out the earlier ones.'''
                 logEntry = LogEntry(self, item)
+                if 'incident' in item:
+                    self.cacheIncident(item['incident'])
+
+                if not self.__ourself(logEntry):
+                    yield logEntry
 
-                user = logEntry.user()
-                if self.username and user and user['email'] == self.username:
-                    '''Filter out actions by ourself.'''
-                    continue
+    def __ourself(self, logEntry):
+        '''Filter out actions by ourself.'''
+        user = logEntry.user()
+        return self.username and user and user['email'] == self.username
 
+    def webhookLogEntries(self, payload):
+        '''Convert the incident messages of a webhook to log entries. Status changes are dated by the incident, the
+        others by the message, to match the log entries of the same event.'''
+        for message in payload.get('messages', []):
+            if not message['type'].startswith('incident.'):
+                continue
+            incident = message['data']['incident']
+            properties = {}
+            properties['id'] = message['id']
+            properties['type'] = message['type'][len('incident.'):]
+            properties['created_at'] = message['created_on']
+            if properties['type'] in ('trigger', 'acknowledge', 'unacknowledge', 'resolve'):
+                properties['created_at'] = incident.get('last_status_change_on') or message['created_on']
+            properties['incident'] = incident
+            properties['service'] = incident['service']
+            properties['channel'] = {'type': 'webhook', 'details': incident.get('trigger_summary_data') or {}}
+            if properties['type'] in ('acknowledge', 'unacknowledge', 'resolve'):
+                if incident.get('last_status_change_by'):
+                    properties['agent'] = dict(incident['last_status_change_by'], type='user')
+            if properties['type'] in ('assign', 'escalate'):
+                if incident.get('assigned_to_user'):
+                    properties['assigned_user'] = incident['assigned_to_user']
+
+            self.cacheIncident(incident)
+            logEntry = LogEntry(self, properties)
+            if not self.__ourself(logEntry):
                 yield logEntry
 
+    def logEntry(self, properties):
+        '''Return the log entry of the properties saved before.'''
+        return LogEntry(self, properties)
+
     def getIncident(self, incidentId):
         assert len(incidentId) > 6
-        return Incident(self, self.get('incidents' + '/' + incidentId))
+        with self.__incidentsLock:
+            if incidentId in self.__incidents:
+                return self.__incidents[incidentId]
+        return self.cacheIncident(self.get('incidents' + '/' + incidentId))
+
+    def __listOpenIncidents(self):
+        offset = 0
+        while True:
+            result = self.get('incidents', {'status': 'triggered,acknowledged', 'offset': offset,
+                                            'limit': self.maxIncidents})
+            for properties in result['incidents']:
+                self.cacheIncident(properties)
+            offset += len(result['incidents'])
+            if not result['incidents'] or offset >= result['total']:
+                break
+
+    def getIncidents(self, incidentIds):
+        '''Get the incidents of the identifiers. All open incidents are listed to the cache on the first miss, so
+        only the resolved ones are get one by one. The others missing wait for the listing, it is tried again by
+        the next one if it fails.'''
+        with self.__incidentsLock:
+            missing = any(incidentId not in self.__incidents for incidentId in incidentIds)
+        if missing:
+            with self.__listingLock:
+                with self.__incidentsLock:
+                    listOpenIncidents = not self.__openIncidentsListed
+                if listOpenIncidents:
+                    self.__listOpenIncidents()
+                    with self.__incidentsLock:
+                        self.__openIncidentsListed = True
+
+        return [self.getIncident(incidentId) for incidentId in incidentIds]
 
 class Incident(dict):
     def __init__(self, client, properties):
@@ -48,7 +167,10 @@ class Incident(dict):
         return str(self['id'])
 
     def put(self, action):
-        self.__client.put('incidents/' + self['id'] + '/' + action)
+        result = self.__client.put('incidents/' + self['id'] + '/' + action)
+        if result:
+            self.update(result)
+        return result
 
 class LogEntry(dict):
     def __init__(self, client, properties):
@@ -65,3 +187,16 @@ class LogEntry(dict):
         if 'agent' in self and self['agent']['type'] == 'user':
             return self['agent']
 
+    def webhook(self):
+        '''Return true if the log entry is received from a webhook.'''
+        return self.get('channel', {}).get('type') == 'webhook'
+
+    def event(self, webhook=None):
+        '''Identify the event of the log entry by the source, the incident, the type and the time in seconds. Log
+        entries received from the webhooks have different identifiers for the same events, they are matched to the
+        ones of the other source by the event. Different log entries of the same source at the same second, like
+        the notifications sent at once, are different events.'''
+        if webhook is None:
+            webhook = self.webhook()
+        return ('webhook/' if webhook else 'poll/') + self['incident']['id'] + '/' + self['type'] + '/' + \
+               self['created_at'][:19]
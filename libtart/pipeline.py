@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+##
+# Tart Integration
+#
+# Copyright (c) 2013, Tart İnternet Teknolojileri Ticaret AŞ
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose with or without fee is hereby
+# granted, provided that the above copyright notice and this permission notice appear in all copies.
+#
+# The software is provided "as is" and the author disclaims all warranties with regard to the software including all
+# implied warranties of merchantability and fitness. In no event shall the author be liable for any special, direct,
+# indirect, or consequential damages or any damages whatsoever resulting from loss of use, data or profits, whether
+# in an action of contract, negligence or other tortious action, arising out of or in connection with the use or
+# performance of this software.
+##
+
+import time
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class Watermark:
+    '''Track completion of the values added in order. Return the last value of the completed prefix.'''
+
+    def __init__(self):
+        self.__marks = deque()
+        self.__lock = threading.Lock()
+
+    def add(self, value):
+        mark = [value, False]
+        with self.__lock:
+            self.__marks.append(mark)
+        return mark
+
+    def done(self, mark):
+        with self.__lock:
+            mark[1] = True
+
+    def pop(self):
+        '''Remove the completed prefix, return the last value of it or None if nothing completed since the last
+        call.'''
+        value = None
+        with self.__lock:
+            while self.__marks and self.__marks[0][1]:
+                value = self.__marks.popleft()[0]
+        return value
+
+class KeyedPipeline:
+    '''Run functions on worker threads keeping the order of the ones with the same key. Functions with different
+    keys run in parallel. Submitting blocks when too many functions are waiting to bound the memory. Remaining
+    functions are skipped after the first error, the error is kept to be raised by the caller.'''
+
+    def __init__(self, workers, size=None):
+        self.__executor = ThreadPoolExecutor(workers)
+        self.__size = size or workers * 10
+        self.__queues = {}
+        self.__waiting = 0
+        self.__condition = threading.Condition()
+        self.__watermark = Watermark()
+        self.error = None
+
+    def submit(self, key, function, value=None):
+        '''Run the function after the ones submitted before with the same key. The value will be returned by
+        watermark() after the function and all the functions submitted before it have completed.'''
+        with self.__condition:
+            while self.__waiting >= self.__size:
+                self.__condition.wait()
+
+            mark = self.__watermark.add(value)
+            self.__waiting += 1
+            if key in self.__queues:
+                self.__queues[key].append((function, mark))
+                return
+            self.__queues[key] = deque()
+
+        self.__executor.submit(self.__run, key, function, mark)
+
+    def __run(self, key, function, mark):
+        while True:
+            if not self.error:
+                try:
+                    function()
+                except Exception as error:
+                    self.error = self.error or error
+                else:
+                    self.__watermark.done(mark)
+
+            with self.__condition:
+                self.__waiting -= 1
+                self.__condition.notify_all()
+                if not self.__queues[key]:
+                    del self.__queues[key]
+                    return
+                function, mark = self.__queues[key].popleft()
+
+    def waiting(self):
+        '''Return the number of the functions submitted but not completed.'''
+        with self.__condition:
+            return self.__waiting
+
+    def watermark(self):
+        return self.__watermark.pop()
+
+    def close(self):
+        '''Wait for all submitted functions.'''
+        self.__executor.shutdown(wait=True)
+
+def coalesced(items, key, timestamp, seconds):
+    '''Group the items in order with the same key within the seconds from the first item of the group. Yield the
+    groups as lists when the window of the group passes by the timestamp of the next item, in the order of their
+    first items.'''
+    groups = OrderedDict()
+    for item in items:
+        now = timestamp(item)
+        while groups:
+            first, (startedAt, group) = next(iter(groups.items()))
+            if startedAt + seconds >= now:
+                break
+            del groups[first]
+            yield group
+
+        if key(item) in groups:
+            groups[key(item)][1].append(item)
+        else:
+            groups[key(item)] = now, [item]
+
+    for startedAt, group in groups.values():
+        yield group
+
+class Budget:
+    '''Time budget of a run. Costs of the items are estimated by their kinds with the exponentially weighted moving
+    averages of the seconds they took, the ones of the kinds not seen yet with the average of all. The last part of
+    the budget is reserved for the items with priority. There is no limit when the seconds is 0. No more items are
+    allowed once the stopped event is set.'''
+
+    weight = 0.2
+
+    def __init__(self, seconds, reserve=0.25, stopped=None):
+        self.__deadline = time.time() + seconds if seconds else None
+        self.__reserveSeconds = seconds * reserve
+        self.__stopped = stopped
+        self.__costs = {}
+        self.__cost = None
+        self.__lock = threading.Lock()
+
+    def remaining(self):
+        if self.__deadline is None:
+            return float('inf')
+        return self.__deadline - time.time()
+
+    def reserved(self):
+        '''Return true if the remaining seconds are reserved for the items with priority.'''
+        return self.remaining() < self.__reserveSeconds
+
+    def estimate(self, kinds):
+        with self.__lock:
+            return sum(self.__costs.get(kind, self.__cost or 0) for kind in kinds)
+
+    def allows(self, kinds, waiting=0, workers=1):
+        '''Return true if the items of the kinds are estimated to complete in the remaining seconds after the
+        waiting ones shared by the workers.'''
+        if self.__stopped and self.__stopped.is_set():
+            return False
+        estimate = self.estimate(kinds)
+        with self.__lock:
+            queued = waiting * (self.__cost or 0)
+        return self.remaining() >= max(estimate, (estimate + queued) / workers)
+
+    def spend(self, kinds, seconds):
+        '''Update the estimates with the seconds the items of the kinds took together.'''
+        with self.__lock:
+            for kind in kinds:
+                cost = seconds / len(kinds)
+                self.__costs[kind] = self.__average(self.__costs.get(kind), cost)
+                self.__cost = self.__average(self.__cost, cost)
+
+    def __average(self, average, value):
+        if average is None:
+            return value
+        return average + self.weight * (value - average)
@@ -0,0 +1,199 @@
+'''Replay synthetic incident storms through the checks against the fake APIs, and resolve some of the incidents
+after their issues are created. Report the wall time, the requests per log entry by the type, and the peak memory.
+Exit with failure when a code path goes over its budget of HTTP calls. Run it from the top directory like this:
+
+    python3 -m libtart.test.benchmark 100 1000 10000 --latency 0.005
+'''
+
+import os
+import sys
+import time
+import shutil
+import threading
+import argparse
+import tempfile
+import tracemalloc
+from collections import Counter
+
+from libtart.checker import PagerDutyJira
+from libtart.api import JSONResponse
+from libtart.test.fakeserver import FakeJira, FakePagerDuty, Server, Storm
+
+'''Most requests a log entry of the type or an issue can cost on average, excluding the pagination.'''
+budgets = {'trigger': 4, 'notify': 1.1, 'acknowledge': 1.5, 'annotate': 1.1, 'resolve': 1.5, 'issue': 1,
+           'pagination': 0.05}
+
+serviceConfig = '''[System Check]
+project = TSS
+issuetype = Task
+
+[Database Check]
+project = TSS
+issuetype = Task
+create-priority = Blocker
+
+[Jira Critical Bug]
+project = TSS
+issuetype = Bug
+'''
+
+def configure(directory, server, workers, coalesceSeconds):
+    '''Write the configurations to the directory, and keep the state of the checker on it.'''
+    with open(os.path.join(directory, 'api.conf'), 'w') as pointer:
+        pointer.write('[DEFAULT]\napplication = tart-integration\nsyslog = no\n\n')
+        pointer.write('[PagerDuty]\naddress = ' + server.address('pagerduty') + 'api/v1/\ntoken = x\n\n')
+        pointer.write('[Jira]\naddress = ' + server.address('jira') + 'rest/api/2/\n')
+        pointer.write('username = pagerduty\npassword = x\n')
+    shutil.copy('action.conf', directory)
+    with open(os.path.join(directory, 'service.conf'), 'w') as pointer:
+        pointer.write(serviceConfig)
+    with open(os.path.join(directory, 'integration.conf'), 'w') as pointer:
+        pointer.write('[PagerDuty]\nworkers = ' + str(workers) + '\n')
+        pointer.write('coalesce-seconds = ' + str(coalesceSeconds) + '\n')
+
+    for name in dir(PagerDutyJira):
+        if name.endswith('File'):
+            setattr(PagerDutyJira, name, os.path.join(directory, name))
+
+class Benchmark:
+    def __init__(self, count, latency=0, workers=1, coalesceSeconds=0, seed=0):
+        self.count = count
+        self.workers = workers
+        self.coalesceSeconds = coalesceSeconds
+        self.pagerDuty = FakePagerDuty()
+        self.storm = Storm(self.pagerDuty, seed)
+        self.storm.generate(count)
+        self.jira = FakeJira(self.storm.jiraUsers)
+        self.server = Server(self.jira, self.pagerDuty, latency)
+        self.requests = Counter()
+        self.entries = Counter()
+        self.lock = threading.Lock()
+
+    def __attribute(self, checker):
+        '''Count the requests of the log entries by their types. Requests are counted by the threads sending them
+        to attribute them while the workers process the log entries in parallel. Requests of the log entries
+        coalesced are shared by them, the ones of the issues created in bulk before the workers start are attributed
+        to the triggers.'''
+        processLogEntries = checker._PagerDutyJira__processLogEntries
+        createStormIssues = checker._PagerDutyJira__createStormIssues
+        sent = threading.local()
+
+        def counted(send):
+            def countedSend(request):
+                sent.count = getattr(sent, 'count', 0) + 1
+                return send(request)
+            return countedSend
+
+        for client in checker._PagerDutyJira__jira, checker._PagerDutyJira__pagerDuty:
+            client._JSONAPI__send = counted(client._JSONAPI__send)
+
+        def attributed(logEntries):
+            before = getattr(sent, 'count', 0)
+            try:
+                return processLogEntries(logEntries)
+            finally:
+                with self.lock:
+                    for logEntry in logEntries:
+                        self.requests[logEntry['type']] += (sent.count - before) / len(logEntries)
+                        self.entries[logEntry['type']] += 1
+
+        def attributedStorm(logEntries, workers):
+            before = self.server.total()
+            try:
+                return createStormIssues(logEntries, workers)
+            finally:
+                self.requests['trigger'] += self.server.total() - before
+
+        checker._PagerDutyJira__processLogEntries = attributed
+        checker._PagerDutyJira__createStormIssues = attributedStorm
+
+    def run(self):
+        directory = tempfile.mkdtemp()
+        workingDirectory = os.getcwd()
+        configure(directory, self.server, self.workers, self.coalesceSeconds)
+        with open(PagerDutyJira.checkPagerDutyTimestampFile, 'w') as pointer:
+            pointer.write(self.storm.timestamp(-1))
+        with open(PagerDutyJira.checkJiraTimestampFile, 'w') as pointer:
+            pointer.write('2000-01-01T00:00')
+
+        os.chdir(directory)
+        tracemalloc.start()
+        try:
+            checker = PagerDutyJira()
+            self.__attribute(checker)
+
+            startedAt = time.time()
+            processed = checker.checkPagerDuty()
+            '''Some of the incidents are resolved after their issues are created.'''
+            self.storm.resolve()
+            processed += checker.checkPagerDuty()
+            self.pagerDutySeconds = time.time() - startedAt
+            self.pagerDutyRequests = self.server.total()
+            self.pagerDutyBytes = self.server.bytes
+            assert processed == len(self.pagerDuty.logEntries), 'Log entries are missed.'
+
+            '''People resolve every third issue.'''
+            for number, issue in enumerate(sorted(self.jira.issues.values(), key=lambda issue: issue['key'])):
+                if number % 3 == 0:
+                    self.jira.change(issue, 'status', {'name': 'Resolved'})
+
+            self.server.requests.clear()
+            self.server.bytes = 0
+            startedAt = time.time()
+            self.issues = checker.checkJira()
+            self.jiraSeconds = time.time() - startedAt
+            self.jiraRequests = self.server.total()
+            self.jiraBytes = self.server.bytes
+            self.peakMemory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            os.chdir(workingDirectory)
+            self.server.stop()
+            shutil.rmtree(directory)
+
+    def overBudget(self):
+        '''Return the code paths over their budgets with their costs.'''
+        costs = {}
+        for type, count in self.entries.items():
+            costs[type] = self.requests[type] / count
+        if self.entries:
+            costs['pagination'] = ((self.pagerDutyRequests - sum(self.requests.values())) /
+                                   len(self.pagerDuty.logEntries))
+        if self.issues:
+            costs['issue'] = self.jiraRequests / self.issues
+        return dict((path, cost) for path, cost in costs.items() if cost > budgets.get(path, 0))
+
+    def report(self):
+        print('{0} log entries with {1} workers, coalesced in {2} seconds'.format(len(self.pagerDuty.logEntries),
+                                                                                   self.workers, self.coalesceSeconds))
+        print('    PagerDuty check: {0:.2f} seconds, {1} requests, {2} KiB, {3:.1f} log entries per second'.format(
+              self.pagerDutySeconds, self.pagerDutyRequests, self.pagerDutyBytes // 1024,
+              len(self.pagerDuty.logEntries) / self.pagerDutySeconds))
+        for type, count in sorted(self.entries.items()):
+            print('        {0}: {1:.2f} requests per log entry'.format(type, self.requests[type] / count))
+        print('    Jira check: {0:.2f} seconds, {1} requests, {2} KiB, {3} issues'.format(
+              self.jiraSeconds, self.jiraRequests, self.jiraBytes // 1024, self.issues))
+        print('    Peak memory: {0:.1f} MiB'.format(self.peakMemory / 1048576))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('.')[0])
+    parser.add_argument('counts', nargs='*', type=int, default=[100, 1000], help='log entries to generate')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to delay the requests')
+    parser.add_argument('--workers', type=int, default=1, help='workers of the PagerDuty check')
+    parser.add_argument('--coalesce', type=float, default=0, help='seconds to coalesce the log entries')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    JSONResponse.debug = False
+    failed = False
+    for count in arguments.counts:
+        benchmark = Benchmark(count, arguments.latency, arguments.workers, arguments.coalesce, arguments.seed)
+        benchmark.run()
+        benchmark.report()
+        for path, cost in sorted(benchmark.overBudget().items()):
+            print('    Over budget: {0} costs {1:.2f} requests, budget is {2}'.format(path, cost, budgets.get(path, 0)))
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
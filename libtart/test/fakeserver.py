@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+##
+# Tart Integration
+#
+# Copyright (c) 2013, Tart İnternet Teknolojileri Ticaret AŞ
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose with or without fee is hereby
+# granted, provided that the above copyright notice and this permission notice appear in all copies.
+#
+# The software is provided "as is" and the author disclaims all warranties with regard to the software including all
+# implied warranties of merchantability and fitness. In no event shall the author be liable for any special, direct,
+# indirect, or consequential damages or any damages whatsoever resulting from loss of use, data or profits, whether
+# in an action of contract, negligence or other tortious action, arising out of or in connection with the use or
+# performance of this software.
+##
+
+'''Local stand-ins for the Jira REST API version 2 and the PagerDuty REST API version 1. Only the resources and
+the parameters used by the clients are implemented. Requests are counted by method and resource.'''
+
+import re
+import gzip
+import json
+import hashlib
+import time
+import random
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from datetime import datetime, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+class FakeJira:
+    workflow = {'Open': {'Start Progress': 'In Progress', 'Resolve Issue': 'Resolved'},
+                'In Progress': {'Stop Progress': 'Open', 'Resolve Issue': 'Resolved'},
+                'Reopened': {'Start Progress': 'In Progress', 'Resolve Issue': 'Resolved'},
+                'Resolved': {'Reopen Issue': 'Reopened', 'Close Issue': 'Closed'},
+                'Closed': {'Reopen Issue': 'Reopened'}}
+    issuetypes = [{'id': '1', 'name': 'Bug'}, {'id': '3', 'name': 'Task'}]
+    priorities = [{'id': str(number), 'name': name}
+                  for number, name in enumerate(['Blocker', 'Critical', 'Major', 'Minor', 'Trivial'], 1)]
+
+    def __init__(self, users=()):
+        self.users = list(users)
+        self.issues = {}
+        self.counters = Counter()
+        self.lock = threading.RLock()
+
+    def now(self):
+        return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:23] + '+0000'
+
+    def newIssue(self, fields):
+        with self.lock:
+            self.counters[fields['project']['key']] += 1
+            key = fields['project']['key'] + '-' + str(self.counters[fields['project']['key']])
+            issue = {'key': key, 'id': str(len(self.issues) + 10000), 'fields': dict(fields), 'comments': [],
+                     'remotelinks': {}}
+            issue['fields'].setdefault('status', {'name': 'Open'})
+            issue['fields'].setdefault('priority', {'name': 'Major'})
+            issue['fields']['created'] = issue['fields']['updated'] = self.now()
+            issue['changelog'] = []
+            self.issues[key] = issue
+            return issue
+
+    def change(self, issue, field, value):
+        old = issue['fields'].get(field)
+        issue['fields'][field] = value
+        issue['fields']['updated'] = self.now()
+        if field in ('status', 'priority', 'assignee') and old != value:
+            issue['changelog'].append({'created': issue['fields']['updated'],
+                                       'items': [{'field': field, 'fromString': old and old.get('name'),
+                                                  'toString': value and value.get('name')}]})
+
+    def touch(self, issue):
+        issue['fields']['updated'] = self.now()
+
+    def __matches(self, jql, issue):
+        fields = issue['fields']
+        pairs = re.findall(r'\(project = "([^"]*)" and issuetype = "([^"]*)"\)', jql)
+        if pairs and (fields['project']['key'], fields['issuetype']['name']) not in pairs:
+            return False
+        project = re.match(r'project = "([^"]*)" and issuetype = "([^"]*)" and', jql)
+        if project and (fields['project']['key'], fields['issuetype']['name']) != project.groups():
+            return False
+        summary = re.search(r'summary ~ "((?:[^"\\]|\\.)*)"', jql)
+        if summary:
+            words = re.findall(r'\w+', summary.group(1).lower())
+            if not set(words) <= set(re.findall(r'\w+', fields['summary'].lower())):
+                return False
+        if 'status != Closed' in jql and fields['status']['name'] == 'Closed':
+            return False
+        updated = re.search(r'updated >(=?) "([^"]*)"', jql)
+        if updated:
+            since = updated.group(2).replace(' ', 'T')
+            if fields['updated'] < since or (not updated.group(1) and fields['updated'] == since):
+                return False
+        return True
+
+    def search(self, parameters):
+        jql = parameters['jql']
+        with self.lock:
+            issues = [issue for issue in self.issues.values() if self.__matches(jql, issue)]
+        if 'order by updated' in jql:
+            issues.sort(key=lambda issue: (issue['fields']['updated'], issue['key']))
+            if 'order by updated asc' not in jql:
+                issues.reverse()
+        else:
+            issues.sort(key=lambda issue: issue['key'])
+        startAt = int(parameters.get('startAt', 0))
+        maxResults = int(parameters.get('maxResults', 50))
+        page = issues[startAt:startAt + maxResults]
+        wanted = parameters.get('fields', '*all').split(',')
+        result = []
+        for issue in page:
+            item = {'key': issue['key'], 'id': issue['id'],
+                    'fields': {field: value for field, value in issue['fields'].items()
+                               if field in wanted or '*all' in wanted}}
+            if 'changelog' in parameters.get('expand', ''):
+                item['changelog'] = {'histories': issue['changelog'], 'total': len(issue['changelog'])}
+            result.append(item)
+        return {'startAt': startAt, 'maxResults': maxResults, 'total': len(issues), 'issues': result}
+
+    def transitions(self, issue):
+        return [{'id': str(abs(hash(name)) % 1000), 'name': name, 'to': {'name': status},
+                 'fields': {'assignee': {'required': False}}}
+                for name, status in sorted(self.workflow[issue['fields']['status']['name']].items())]
+
+    def handle(self, method, path, parameters, body):
+        with self.lock:
+            return self.__handle(method, path, parameters, body)
+
+    def __handle(self, method, path, parameters, body):
+        parts = path.split('/')
+        if path == 'search':
+            return 'search', 200, self.search(parameters)
+        if path == 'issuetype':
+            return path, 200, self.issuetypes
+        if path == 'priority':
+            return path, 200, self.priorities
+        if path == 'user/search':
+            name = parameters['username'].lower()
+            users = [user for user in self.users
+                     if name == '.' or name in (user['name'].lower(), user['emailAddress'].lower())]
+            startAt = int(parameters.get('startAt', 0))
+            return path, 200, users[startAt:startAt + int(parameters.get('maxResults', 50))]
+        if path == 'issue' and method == 'POST':
+            issue = self.newIssue(body['fields'])
+            return path, 201, {'id': issue['id'], 'key': issue['key']}
+        if path == 'issue/bulk' and method == 'POST':
+            issues = [self.newIssue(update['fields']) for update in body['issueUpdates']]
+            return path, 201, {'issues': [{'id': issue['id'], 'key': issue['key']} for issue in issues],
+                               'errors': []}
+        if parts[0] == 'issue' and len(parts) >= 2:
+            issue = self.issues.get(parts[1])
+            if not issue:
+                return 'issue/{key}', 404, {'errorMessages': ['Issue Does Not Exist']}
+            resource = 'issue/{key}' + ''.join('/' + part for part in parts[2:])
+            if len(parts) == 2 and method == 'GET':
+                return resource, 200, {'key': issue['key'], 'id': issue['id'], 'fields': issue['fields']}
+            if len(parts) == 2 and method == 'PUT':
+                return resource, self.__update(issue, body), None
+            if parts[2:] == ['remotelink'] and method == 'GET':
+                return resource, 200, list(issue['remotelinks'].values())
+            if parts[2:] == ['remotelink'] and method == 'POST':
+                issue['remotelinks'][body['globalId']] = dict(body, id=len(issue['remotelinks']) + 1)
+                self.touch(issue)
+                return resource, 201, {'id': len(issue['remotelinks'])}
+            if parts[2:] == ['transitions'] and method == 'GET':
+                return resource, 200, {'transitions': self.transitions(issue)}
+            if parts[2:] == ['transitions'] and method == 'POST':
+                for transition in self.transitions(issue):
+                    if transition['id'] == body['transition']['id']:
+                        self.change(issue, 'status', {'name': transition['to']['name']})
+                        return resource, self.__update(issue, body), None
+                return resource, 400, {'errorMessages': ['Transition is not valid']}
+            if parts[2:] == ['comment'] and method == 'POST':
+                issue['comments'].append(body['body'])
+                self.touch(issue)
+                return resource, 201, {'id': str(len(issue['comments']))}
+            if parts[2:] == ['assignee'] and method == 'PUT':
+                self.change(issue, 'assignee', body)
+                return resource, 204, None
+        return path, 404, {'errorMessages': ['Not found']}
+
+    def __update(self, issue, body):
+        for field, value in body.get('fields', {}).items():
+            self.change(issue, field, value)
+        for operation in body.get('update', {}).get('comment', []):
+            issue['comments'].append(operation['add']['body'])
+        self.touch(issue)
+        return 204
+
+class FakePagerDuty:
+    def __init__(self):
+        self.incidents = {}
+        self.logEntries = []
+        self.lock = threading.RLock()
+
+    def addLogEntry(self, logEntry):
+        with self.lock:
+            self.logEntries.append(logEntry)
+
+    def handle(self, method, path, parameters, body):
+        with self.lock:
+            return self.__handle(method, path, parameters, body)
+
+    def __handle(self, method, path, parameters, body):
+        parts = path.split('/')
+        if path == 'log_entries':
+            entries = [entry for entry in self.logEntries
+                       if parameters.get('since', '') <= entry['created_at'] <= parameters.get('until', '~')]
+            entries.sort(key=lambda entry: entry['created_at'], reverse=True)
+            offset = int(parameters.get('offset', 0))
+            limit = int(parameters.get('limit', 100))
+            included = parameters.get('include[]', [])
+            page = []
+            for entry in entries[offset:offset + limit]:
+                entry = dict(entry)
+                if 'incident' in included:
+                    entry['incident'] = dict(self.incidents[entry['incident']['id']])
+                if 'service' not in included:
+                    entry.pop('service', None)
+                page.append(entry)
+            return path, 200, {'log_entries': page, 'total': len(entries), 'offset': offset, 'limit': limit}
+        if path == 'incidents':
+            statuses = parameters.get('status', 'triggered,acknowledged,resolved').split(',')
+            incidents = [incident for incident in self.incidents.values() if incident['status'] in statuses]
+            offset = int(parameters.get('offset', 0))
+            limit = int(parameters.get('limit', 100))
+            return path, 200, {'incidents': incidents[offset:offset + limit], 'total': len(incidents),
+                               'offset': offset, 'limit': limit}
+        if parts[0] == 'incidents' and len(parts) >= 2:
+            incident = self.incidents.get(parts[1])
+            if not incident:
+                return 'incidents/{id}', 404, {'error': {'message': 'Not Found'}}
+            if len(parts) == 2 and method == 'GET':
+                return 'incidents/{id}', 200, incident
+            if len(parts) == 3 and method == 'PUT':
+                status = {'acknowledge': 'acknowledged', 'resolve': 'resolved'}.get(parts[2], 'triggered')
+                if incident['status'] == 'resolved' or incident['status'] == status:
+                    return 'incidents/{id}/' + parts[2], 400, {'error': {'message': 'Incident Already ' + status}}
+                incident['status'] = status
+                return 'incidents/{id}/' + parts[2], 200, incident
+        return path, 404, {'error': {'message': 'Not Found'}}
+
+class Server(ThreadingMixIn, HTTPServer):
+    '''Serve the fake APIs under /jira/ and /pagerduty/ with keep-alive connections. Requests are delayed by the
+    latency seconds. Responses of the GET requests have ETags, larger ones are compressed if accepted. Bytes of the
+    response bodies are counted.'''
+    daemon_threads = True
+    compressBytes = 1024
+
+    def __init__(self, jira, pagerDuty, latency=0, address=('127.0.0.1', 0)):
+        self.jira = jira
+        self.pagerDuty = pagerDuty
+        self.latency = latency
+        self.requests = Counter()
+        self.bytes = 0
+        self.requestsLock = threading.Lock()
+        HTTPServer.__init__(self, address, Handler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def address(self, application):
+        return 'http://%s:%d/%s/' % (self.server_address[0], self.server_address[1], application)
+
+    def count(self, application, method, resource):
+        with self.requestsLock:
+            self.requests[application, method, resource] += 1
+
+    def countBytes(self, count):
+        with self.requestsLock:
+            self.bytes += count
+
+    def total(self, application=None, method=None):
+        with self.requestsLock:
+            return sum(count for (requestApplication, requestMethod, resource), count in self.requests.items()
+                       if application in (None, requestApplication) and method in (None, requestMethod))
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *arguments):
+        pass
+
+    def __handle(self, method):
+        address = urlsplit(self.path)
+        content = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        body = json.loads(content.decode('utf-8')) if content else None
+        parameters = {}
+        for key, values in parse_qs(address.query).items():
+            parameters[key] = values if key.endswith('[]') else values[0]
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        application, path = address.path.strip('/').split('/', 1)
+        if application == 'jira':
+            path = path[len('rest/api/2/'):]
+            resource, code, response = self.server.jira.handle(method, path, parameters, body)
+        else:
+            path = path[len('api/v1/'):]
+            resource, code, response = self.server.pagerDuty.handle(method, path, parameters, body)
+        self.server.count(application, method, resource)
+
+        content = json.dumps(response).encode('utf-8') if response is not None else b''
+        headers = {'Content-Type': 'application/json'}
+        if method == 'GET' and code == 200:
+            headers['ETag'] = '"' + hashlib.md5(content).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                code = 304
+                content = b''
+        if len(content) > self.server.compressBytes and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            content = gzip.compress(content)
+        self.server.countBytes(len(content))
+
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+class Storm:
+    '''Generate seeded synthetic incidents and their log entries on the fake APIs. Every incident is triggered by
+    the Nagios, notified, acknowledged, annotated and mostly resolved.'''
+
+    services = ['System Check', 'Database Check', 'Jira Critical Bug']
+    hosts = ['web', 'db', 'cache', 'lb', 'mail', 'dns', 'queue', 'search']
+    checks = ['Disk', 'Load', 'HTTP', 'Ping', 'Swap', 'MySQL']
+
+    def __init__(self, pagerDuty, seed=0):
+        self.pagerDuty = pagerDuty
+        self.random = random.Random(seed)
+        self.users = [{'id': 'P%06d' % number, 'type': 'user', 'name': 'User ' + str(number),
+                       'email': 'user%d@tart.com.tr' % number} for number in range(200)]
+        self.jiraUsers = [{'name': 'user' + str(number), 'emailAddress': user['email'], 'displayName': user['name']}
+                          for number, user in enumerate(self.users) if number % 10]
+        self.startedAt = datetime.utcnow() - timedelta(hours=1)
+        self.sequence = 0
+        self.seconds = 0
+
+    def timestamp(self, seconds):
+        return (self.startedAt + timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:23] + 'Z'
+
+    def logEntry(self, incident, type, seconds, **properties):
+        self.sequence += 1
+        logEntry = {'id': 'L%08d' % self.sequence, 'type': type, 'created_at': self.timestamp(seconds),
+                    'incident': {'id': incident['id']}, 'service': incident['service']}
+        logEntry.update(properties)
+        self.pagerDuty.addLogEntry(logEntry)
+        return logEntry
+
+    def incident(self, number, seconds):
+        host = self.random.choice(self.hosts) + str(self.random.randrange(20)) + '.tart.local'
+        check = self.random.choice(self.checks)
+        user = self.random.choice(self.users)
+        incident = {'id': 'P%06dX' % number, 'incident_number': number, 'status': 'triggered',
+                    'html_url': 'https://tart.pagerduty.com/incidents/P%06dX' % number,
+                    'service': {'name': self.random.choice(self.services)}, 'assigned_to_user': user,
+                    'trigger_summary_data': {'HOSTNAME': host, 'SERVICEDESC': check, 'SERVICESTATE': 'CRITICAL'}}
+        self.pagerDuty.incidents[incident['id']] = incident
+        return incident
+
+    def generate(self, count, resolved=0.5):
+        '''Generate log entries about the count, five per incident except the ones left unresolved.'''
+        incidents = max(1, int(count // (4 + resolved)))
+        seconds = 0
+        for number in range(1, incidents + 1):
+            incident = self.incident(number, seconds)
+            user = incident['assigned_to_user']
+            nagios = {'type': 'nagios', 'details': {'HOSTADDRESS': '10.0.0.' + str(number % 250),
+                                                    'SERVICEOUTPUT': 'CRITICAL - it is broken'}}
+            self.logEntry(incident, 'trigger', seconds, channel=nagios)
+            self.logEntry(incident, 'notify', seconds + 1, user=user,
+                          notification={'type': 'sms', 'status': 'success', 'address': '+905555555555'})
+            self.logEntry(incident, 'acknowledge', seconds + 30, agent=user, channel={'type': 'sms'})
+            self.logEntry(incident, 'annotate', seconds + 40, agent=user,
+                          channel={'type': 'note', 'content': 'Looking at it.'})
+            if self.random.random() < resolved:
+                self.logEntry(incident, 'resolve', seconds + 60, agent=user, channel={'type': 'website'})
+                incident['status'] = 'resolved'
+            else:
+                incident['status'] = 'acknowledged'
+            seconds += self.random.randrange(3)
+        self.seconds = seconds + 60
+
+    def resolve(self, fraction=0.5):
+        '''Resolve some of the incidents left unresolved after all of the log entries generated, the ones which
+        have their issues by then. Return the number of them.'''
+        count = 0
+        for incident in self.pagerDuty.incidents.values():
+            if incident['status'] != 'resolved' and self.random.random() < fraction:
+                self.seconds += 1 + self.random.randrange(3)
+                self.logEntry(incident, 'resolve', self.seconds, agent=incident['assigned_to_user'],
+                              channel={'type': 'website'})
+                incident['status'] = 'resolved'
+                count += 1
+        return count
@@ -0,0 +1,85 @@
+'''Replay log entries through the PagerDuty check against the fake APIs refusing the comments. Exit with failure
+unless the log entries refused with 403 are kept on the journal and processed after the Jira recovers, and the
+ones refused with 400 are dropped. Run it from the top directory like this:
+
+    python3 -m libtart.test.journal
+'''
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+
+from libtart.checker import PagerDutyJira
+from libtart.database import StateDatabase
+from libtart.api import JSONResponse
+from libtart.test.benchmark import configure
+from libtart.test.fakeserver import FakeJira, FakePagerDuty, Server, Storm
+
+def replay(code):
+    '''Run the check while the comments are refused with the code, and again after the Jira recovers. Return
+    the number of the log entries, the ones left on the journal after the refusal, and the ones processed.'''
+    pagerDuty = FakePagerDuty()
+    storm = Storm(pagerDuty)
+    storm.generate(100)
+    jira = FakeJira(storm.jiraUsers)
+    server = Server(jira, pagerDuty)
+
+    refusing = [True]
+    handle = jira.handle
+    def refusingHandle(method, path, parameters, body):
+        if refusing[0] and method == 'POST' and path.endswith('/comment'):
+            return 'comment', code, {'errorMessages': ['Refused.']}
+        return handle(method, path, parameters, body)
+    jira.handle = refusingHandle
+
+    directory = tempfile.mkdtemp()
+    workingDirectory = os.getcwd()
+    configure(directory, server, 1, 0)
+    with open(PagerDutyJira.checkPagerDutyTimestampFile, 'w') as pointer:
+        pointer.write(storm.timestamp(-1))
+
+    os.chdir(directory)
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        checker = PagerDutyJira()
+        processed = checker.checkPagerDuty()
+        with StateDatabase(PagerDutyJira.stateDatabaseFile, 'pagerduty') as database:
+            journaled = len(database.journalEntries())
+        refusing[0] = False
+        processed += checker.checkPagerDuty()
+    finally:
+        sys.stderr = stderr
+        os.chdir(workingDirectory)
+        server.stop()
+        shutil.rmtree(directory)
+    return len(pagerDuty.logEntries), journaled, processed
+
+def main():
+    JSONResponse.debug = False
+    PagerDutyJira.journalRetrySeconds = 0
+    failures = []
+
+    count, journaled, processed = replay(403)
+    if not journaled:
+        failures.append('Log entries refused with 403 are not kept on the journal')
+    if processed != count:
+        failures.append('{0} log entries processed after 403, expected {1}'.format(processed, count))
+    print('{0} log entries, {1} retried after 403'.format(count, journaled))
+
+    count, journaled, processed = replay(400)
+    if journaled:
+        failures.append('{0} log entries refused with 400 are left on the journal'.format(journaled))
+    if processed == count:
+        failures.append('Log entries refused with 400 are processed after the recovery')
+    print('{0} log entries, {1} dropped after 400'.format(count, count - processed))
+
+    for failure in failures:
+        print(failure)
+    print('failed' if failures else 'ok')
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''Replay an incident with notifications sent at the same second, one of them still in progress, through the
+PagerDuty check against the fake APIs. Exit with failure unless the log entries of the incident are parked until
+the notification completes, and processed after it, while the others are processed on the first run. Replay
+another notification in progress longer than the parking seconds, and fail unless it is processed. Run it from
+the top directory like this:
+
+    python3 -m libtart.test.parking
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+from libtart.checker import PagerDutyJira
+from libtart.api import JSONResponse
+from libtart.test.benchmark import configure
+from libtart.test.fakeserver import FakeJira, FakePagerDuty, Server, Storm
+
+def main():
+    JSONResponse.debug = False
+    pagerDuty = FakePagerDuty()
+    storm = Storm(pagerDuty)
+    storm.generate(100)
+    jira = FakeJira(storm.jiraUsers)
+    server = Server(jira, pagerDuty)
+
+    '''Call the assignee of an incident left open half a second after the SMS.'''
+    sms = next(logEntry for logEntry in pagerDuty.logEntries if logEntry['type'] == 'notify' and
+               pagerDuty.incidents[logEntry['incident']['id']]['status'] != 'resolved')
+    phone = dict(sms, id='L99999999', created_at=sms['created_at'][:20] + '500Z',
+                 notification={'type': 'phone', 'status': 'in_progress', 'address': '+905555555556'})
+    pagerDuty.addLogEntry(phone)
+    parked = [logEntry for logEntry in pagerDuty.logEntries if logEntry['incident']['id'] == phone['incident']['id']
+              and logEntry['created_at'] >= phone['created_at']]
+
+    directory = tempfile.mkdtemp()
+    workingDirectory = os.getcwd()
+    configure(directory, server, 1, 0)
+    with open(os.path.join(directory, 'integration.conf'), 'a') as pointer:
+        pointer.write('parking-seconds = 86400\n')
+    with open(PagerDutyJira.checkPagerDutyTimestampFile, 'w') as pointer:
+        pointer.write(storm.timestamp(-1))
+
+    os.chdir(directory)
+    failures = []
+    try:
+        checker = PagerDutyJira()
+        processed = checker.checkPagerDuty()
+        if processed != len(pagerDuty.logEntries) - len(parked):
+            failures.append('{0} log entries processed while parked, expected {1}'.format(
+                            processed, len(pagerDuty.logEntries) - len(parked)))
+        processed = checker.checkPagerDuty()
+        if processed:
+            failures.append('{0} log entries processed while the notification in progress'.format(processed))
+
+        phone['notification'] = dict(phone['notification'], status='success')
+        processed = checker.checkPagerDuty()
+        if processed != len(parked):
+            failures.append('{0} parked log entries processed, expected {1}'.format(processed, len(parked)))
+        if not any('via phone' in comment for issue in jira.issues.values() for comment in issue['comments']):
+            failures.append('Comment of the phone call is not posted')
+
+        '''Call again, the call is in progress longer than the parking seconds.'''
+        latest = max(logEntry['created_at'] for logEntry in pagerDuty.logEntries)
+        pagerDuty.addLogEntry(dict(phone, id='L99999998', created_at=latest,
+                                   notification=dict(phone['notification'], status='in_progress')))
+        with open('integration.conf') as pointer:
+            content = pointer.read().replace('parking-seconds = 86400', 'parking-seconds = 60')
+        with open('integration.conf', 'w') as pointer:
+            pointer.write(content)
+        processed = PagerDutyJira().checkPagerDuty()
+        if processed != 1:
+            failures.append('{0} log entries processed after parked too long, expected 1'.format(processed))
+    finally:
+        os.chdir(workingDirectory)
+        server.stop()
+        shutil.rmtree(directory)
+
+    for failure in failures:
+        print(failure)
+    print('{0} log entries, {1} parked: {2}'.format(len(pagerDuty.logEntries), len(parked),
+                                                    'failed' if failures else 'ok'))
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
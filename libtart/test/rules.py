@@ -0,0 +1,49 @@
+'''Compare the cost of matching the actions for the updated issues with the configuration parser and with the
+compiled rules. Run from the root directory as python3 -m libtart.test.rules'''
+
+import random
+import tempfile
+from timeit import timeit
+
+from libtart.configuration import ConfigParser, Rules
+
+statuses = ['Open', 'In Progress', 'Reopened', 'Resolved', 'Closed']
+priorities = ['Blocker', 'Critical', 'Major', 'Minor', 'Trivial']
+issueCount = 10000
+actionCount = 15
+
+random.seed(0)
+with tempfile.NamedTemporaryFile('w', suffix='.conf') as actionFile:
+    for number in range(actionCount):
+        actionFile.write('[action' + str(number) + ']\n')
+        actionFile.write('match-status = ' + ', '.join(random.sample(statuses, 2)) + '\n')
+        actionFile.write('match-priority = ' + ', '.join(random.sample(priorities, 2)) + '\n')
+    actionFile.flush()
+    actionConfig = ConfigParser(actionFile.name)
+
+serviceConfig = ConfigParser('service.conf')
+issues = [(random.choice(statuses), random.choice(priorities)) for number in range(issueCount)]
+
+def matchWithConfigParser():
+    for status, priority in issues:
+        [action for action in actionConfig.sections()
+                if actionConfig.filter(action, 'match-status', status) or
+                   actionConfig.filter(action, 'match-priority', priority)]
+
+rules = Rules(actionConfig, serviceConfig)
+
+def matchWithRules():
+    for status, priority in issues:
+        rules.matchingActions(status, priority)
+
+for status, priority in issues:
+    assert [action for action in actionConfig.sections()
+                   if actionConfig.filter(action, 'match-status', status) or
+                      actionConfig.filter(action, 'match-priority', priority)] == list(rules.matchingActions(status,
+                                                                                                             priority))
+
+repeat = 3
+for name, function in (('ConfigParser', matchWithConfigParser), ('Rules', matchWithRules)):
+    seconds = timeit(function, number=repeat) / repeat
+    print(name + ': ' + str(issueCount) + ' issues x ' + str(actionCount) + ' actions in ' +
+          str(round(seconds * 1000, 2)) + ' ms, ' + str(round(seconds / issueCount * 1e6, 3)) + ' us per issue')
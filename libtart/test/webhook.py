@@ -0,0 +1,14 @@
+import sys
+import os
+from urllib.request import Request, urlopen
+
+address = sys.argv[1] if len(sys.argv) > 1 else 'http://localhost:8080/'
+token = sys.argv[2] if len(sys.argv) > 2 else ''
+directory = os.path.join(os.path.dirname(__file__), 'webhooks')
+
+for filename in sorted(os.listdir(directory)):
+    with open(os.path.join(directory, filename), 'rb') as pointer:
+        request = Request(address + filename.split('.')[0], pointer.read(),
+                          {'Content-Type': 'application/json', 'X-Webhook-Token': token})
+    with urlopen(request) as response:
+        print(filename, response.status)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+##
+# Tart Integration
+#
+# Copyright (c) 2013, Tart İnternet Teknolojileri Ticaret AŞ
+#
+# Permission to use, copy, modify, and/or distribute this software for any purpose with or without fee is hereby
+# granted, provided that the above copyright notice and this permission notice appear in all copies.
+#
+# The software is provided "as is" and the author disclaims all warranties with regard to the software including all
+# implied warranties of merchantability and fitness. In no event shall the author be liable for any special, direct,
+# indirect, or consequential damages or any damages whatsoever resulting from loss of use, data or profits, whether
+# in an action of contract, negligence or other tortious action, arising out of or in connection with the use or
+# performance of this software.
+##
+
+import hmac
+import json
+import queue
+import threading
+import traceback
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+from .metrics import metrics
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class WebhookReceiver:
+    '''Receive the PagerDuty webhooks on /pagerduty and the Jira webhooks on /jira. Payloads are normalized to log
+    entries and issues by the checker, and put to a bounded queue to be processed one by one on the consumer thread
+    by the same logic as the checks. Payloads are refused with 503 when the queue is full, the senders retry them
+    and the catch-up checks get them anyway.
+
+    Payloads are accepted only with the shared token, on the token parameter of the address or on the
+    X-Webhook-Token header, as they update the issues and the incidents.'''
+
+    size = 1000
+    address = '127.0.0.1'
+
+    def __init__(self, checker, token, port, address=None, size=None):
+        if not token:
+            raise ValueError('Webhook token is required.')
+        self.__checker = checker
+        self.__token = token.encode('utf-8')
+        self.__queue = queue.Queue(size or self.size)
+        self.__server = ThreadingHTTPServer((address or self.address, int(port)), self.__handler())
+        self.__threads = []
+        self.__stopped = threading.Event()
+
+    def __handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                address = urlsplit(self.path)
+                token = self.headers.get('X-Webhook-Token') or parse_qs(address.query).get('token', [''])[0]
+                self.send_response(receiver.receive(address.path.strip('/'), content, token))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *arguments): pass
+
+        return Handler
+
+    def receive(self, source, content, token):
+        '''Queue the payload, return the HTTP status code for the sender.'''
+        if not hmac.compare_digest(token.encode('utf-8'), self.__token):
+            metrics.increment('tart_webhooks_refused_total', 'Webhooks refused.', source=source,
+                              reason='token')
+            return 403
+        if source not in ('pagerduty', 'jira'):
+            return 404
+        try:
+            payload = json.loads(content.decode('utf-8'))
+        except ValueError:
+            return 400
+        try:
+            self.__queue.put_nowait((source, payload))
+        except queue.Full:
+            metrics.increment('tart_webhooks_refused_total', 'Webhooks refused.', source=source, reason='full')
+            return 503
+        metrics.increment('tart_webhooks_received_total', 'Webhooks received.', source=source)
+        return 202
+
+    def process(self, source, payload):
+        '''Process a payload, return the number of the processed items.'''
+        if source == 'pagerduty':
+            return self.__checker.processLogEntries(self.__checker.webhookLogEntries(payload))
+        issue = self.__checker.webhookIssue(payload)
+        if issue:
+            return self.__checker.processIssues([issue])
+        return 0
+
+    def consume(self):
+        '''Process the queued payloads until stopped. The checks lock their states, so the log entries are not
+        processed while the PagerDuty check is running. The payloads left on the queue when stopped are dropped,
+        the catch-up checks get them on the next run.'''
+        while True:
+            item = self.__queue.get()
+            if item is None or self.__stopped.is_set():
+                self.__queue.task_done()
+                break
+            try:
+                self.process(*item)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.__queue.task_done()
+
+    def start(self):
+        self.__threads = [threading.Thread(target=self.__server.serve_forever, daemon=True),
+                          threading.Thread(target=self.consume, daemon=True)]
+        for thread in self.__threads:
+            thread.start()
+
+    def join(self):
+        '''Wait for the queued payloads to be processed.'''
+        self.__queue.join()
+
+    def stop(self):
+        '''Stop receiving, wait for the payload being processed.'''
+        self.__stopped.set()
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()